@@ -5,13 +5,18 @@ Monitors input directory and processes new videos automatically
 """
 
 import os
+import sys
 import time
+import asyncio
 import logging
+import sqlite3
 import threading
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
 from watchdog.events import FileSystemEventHandler
-from video_transcoder import VideoTranscoder
+from video_transcoder import VideoTranscoder, FFMPEG_THREADS, probe_cached
 
 # Configure logging
 logging.basicConfig(
@@ -23,147 +28,364 @@ logging.basicConfig(
     ]
 )
 
+# Supported video formats
+VIDEO_EXTENSIONS = frozenset({'.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm', '.m4v'})
+
+def is_video(path: str) -> bool:
+    """Check a path's extension without building a Path (called for every event)"""
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+# Filesystems on which inotify/ReadDirectoryChangesW miss changes made by other hosts
+NETWORK_FILESYSTEMS = {
+    'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'ceph', '9p',
+    'fuse.sshfs', 'fuse.glusterfs', 'fuse.grpcfuse', 'fuse.rclone', 'davfs'
+}
+
+def is_network_path(path: Path) -> bool:
+    """Check whether a path lives on a network filesystem"""
+    path = path.resolve()
+
+    if os.name == 'nt':
+        import ctypes
+        DRIVE_REMOTE = 4
+        drive = os.path.splitdrive(str(path))[0]
+        if drive.startswith('\\\\'):  # UNC share
+            return True
+        return ctypes.windll.kernel32.GetDriveTypeW(drive + '\\') == DRIVE_REMOTE
+
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return False
+
+    # The filesystem is the one of the longest mount point containing the path
+    path_str = str(path)
+    best_mount, fs_type = '', None
+    for fields in mounts:
+        if len(fields) < 3:
+            continue
+        mount_point = fields[1].replace('\\040', ' ')
+        if ((path_str == mount_point or path_str.startswith(mount_point.rstrip('/') + '/'))
+                and len(mount_point) > len(best_mount)):
+            best_mount, fs_type = mount_point, fields[2]
+
+    return fs_type in NETWORK_FILESYSTEMS
+
+def default_workers() -> int:
+    """One transcode per FFMPEG_THREADS cores
+
+    Each run caps its decoder and filter graph at FFMPEG_THREADS and shares
+    the same number of threads between the ladder's encoders.
+    """
+    return max(1, (os.cpu_count() or 1) // FFMPEG_THREADS)
+
+def _run_transcode(file_path: str, output_dir: str):
+    """Transcode one video (runs in a worker process)"""
+    transcoder = VideoTranscoder(file_path, output_dir, threads=FFMPEG_THREADS)
+    transcoder.process()
+
+# Default location of the ProcessedIndex database
+DEFAULT_STATE_DB = Path.home() / '.cache' / 'transcoder' / 'state.sqlite'
+
+class ProcessedIndex:
+    """Remembers transcoded videos across restarts, keyed by (path, mtime, size)"""
+
+    def __init__(self, db_path: Path = DEFAULT_STATE_DB):
+        db_path = Path(db_path)
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Used from both the watchdog thread and the event loop
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS done("
+                "path TEXT, mtime INTEGER, size INTEGER, manifest TEXT, "
+                "PRIMARY KEY(path, mtime, size))"
+            )
+
+    @staticmethod
+    def _key(file_path: Path) -> tuple:
+        stat = file_path.stat()
+        return (str(file_path.resolve()), stat.st_mtime_ns, stat.st_size)
+
+    def is_done(self, file_path: Path) -> bool:
+        """Check whether this exact file was transcoded and its output still exists"""
+        try:
+            key = self._key(file_path)
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            row = self.db.execute(
+                "SELECT manifest FROM done WHERE path = ? AND mtime = ? AND size = ?", key
+            ).fetchone()
+        return row is not None and Path(row[0]).exists()
+
+    def mark_done(self, file_path: Path, manifest: Path):
+        """Record a finished transcode"""
+        key = self._key(file_path)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?)",
+                            (*key, str(manifest.resolve())))
+
 class VideoProcessingHandler(FileSystemEventHandler):
-    def __init__(self, input_dir: str, output_base_dir: str):
+    """Queues new videos from watchdog events and transcodes them
+
+    Watchdog calls the on_* handlers from its observer thread; the queue is
+    consumed by process_queue on the asyncio loop set in self.loop.
+    """
+
+    def __init__(self, input_dir: str, output_base_dir: str, max_workers: int = None,
+                 index: ProcessedIndex = None):
         self.input_dir = Path(input_dir)
         self.output_base_dir = Path(output_base_dir)
-        self.processing_queue = []
+        self.index = index or ProcessedIndex()
+        # Both are set by BatchProcessor._run: before Python 3.10 an asyncio
+        # Queue binds to the loop current when it is created
+        self.loop = None
+        self.processing_queue = None
         self.processing_lock = threading.Lock()
 
-        # Supported video formats
-        self.video_extensions = {'.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm', '.m4v'}
+        # Files queued, stabilising or transcoding, so repeated events for them are ignored
+        self.pending = set()
+
+        # Set once the writer has closed a file, so it needs no stability check
+        self.closed_events = {}
+
+        # Per-file tasks, referenced until they finish
+        self.tasks = set()
 
-        # Start processing thread
-        self.processing_thread = threading.Thread(target=self.process_queue, daemon=True)
-        self.processing_thread.start()
+        # Each FFmpeg run is capped at FFMPEG_THREADS, so several videos are
+        # transcoded side by side to keep every core busy
+        self.pool = ProcessPoolExecutor(max_workers=max_workers or default_workers())
 
     def on_created(self, event):
-        if not event.is_directory:
-            file_path = Path(event.src_path)
-            if file_path.suffix.lower() in self.video_extensions:
-                self.add_to_queue(file_path)
+        if not event.is_directory and is_video(event.src_path):
+            self.add_to_queue(Path(event.src_path))
 
     def on_moved(self, event):
-        if not event.is_directory:
+        if not event.is_directory and is_video(event.dest_path):
             file_path = Path(event.dest_path)
-            if file_path.suffix.lower() in self.video_extensions:
-                self.add_to_queue(file_path)
+            # Renaming into place is the last step of an upload
+            self.add_to_queue(file_path)
+            self.mark_closed(file_path)
+
+    def on_closed(self, event):
+        # Delivered for inotify IN_CLOSE_WRITE: the writer is done with the file
+        if not event.is_directory and is_video(event.src_path):
+            file_path = Path(event.src_path)
+            self.add_to_queue(file_path)
+            self.mark_closed(file_path)
+
+    def _closed_event(self, file_path: Path) -> asyncio.Event:
+        return self.closed_events.setdefault(file_path, asyncio.Event())
+
+    def mark_closed(self, file_path: Path):
+        """Record that a queued file is completely written and wake up any waiter"""
+        self.loop.call_soon_threadsafe(self._set_closed, file_path)
+
+    def _set_closed(self, file_path: Path):
+        # Only queued files get an event: anything else would never be popped
+        # by finish() and would skip the stability check of a later upload
+        with self.processing_lock:
+            if file_path not in self.pending:
+                return
+        self._closed_event(file_path).set()
+
+    def _enqueue(self, file_path: Path):
+        # Start from a fresh event so a close left over from an earlier
+        # upload to the same path does not count for this one
+        self.closed_events[file_path] = asyncio.Event()
+        self.processing_queue.put_nowait(file_path)
 
     def add_to_queue(self, file_path: Path):
         """Add video file to processing queue"""
+        if self.index.is_done(file_path):
+            logging.info(f"Already processed, skipping: {file_path.name}")
+            return
         with self.processing_lock:
-            if file_path not in self.processing_queue:
-                self.processing_queue.append(file_path)
-                logging.info(f"Added to queue: {file_path.name}")
+            if file_path in self.pending:
+                return
+            self.pending.add(file_path)
+        self.loop.call_soon_threadsafe(self._enqueue, file_path)
+        logging.info(f"Added to queue: {file_path.name}")
 
-    def process_queue(self):
+    async def process_queue(self):
         """Process videos from queue"""
         while True:
-            try:
-                with self.processing_lock:
-                    if not self.processing_queue:
-                        time.sleep(5)
-                        continue
+            video_file = await self.processing_queue.get()
+            # Each video waits for its upload on its own task, so a slow
+            # upload does not hold up the videos queued after it
+            task = asyncio.create_task(self.process_video(video_file))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def process_video(self, video_file: Path):
+        """Wait for a video to be fully written, then transcode it in the worker pool"""
+        try:
+            await self.wait_for_stable_file(video_file)
 
-                    video_file = self.processing_queue.pop(0)
+            # Create output directory for this video
+            video_name = video_file.stem
+            video_output_dir = self.output_base_dir / video_name
+            video_output_dir.mkdir(parents=True, exist_ok=True)
 
-                # Wait for file to be fully written (check file size stability)
-                self.wait_for_stable_file(video_file)
+            # Probe now, while earlier videos are still encoding; the worker
+            # picks the result up from the probe cache in the output directory
+            try:
+                await asyncio.to_thread(probe_cached, str(video_file),
+                                        video_output_dir / '.probe_cache.json')
+            except Exception as e:
+                logging.warning(f"Could not probe {video_file.name}: {e}")
 
-                # Create output directory for this video
-                video_name = video_file.stem
-                video_output_dir = self.output_base_dir / video_name
+            logging.info(f"Processing: {video_file.name} -> {video_output_dir}")
 
-                logging.info(f"Processing: {video_file.name} -> {video_output_dir}")
+            await self.loop.run_in_executor(
+                self.pool, _run_transcode, str(video_file), str(video_output_dir)
+            )
 
-                # Process the video
-                transcoder = VideoTranscoder(str(video_file), str(video_output_dir))
-                transcoder.process()
+            manifest = video_output_dir / "hls" / "master.m3u8"
+            if manifest.exists():
+                self.index.mark_done(video_file, manifest)
 
-                logging.info(f"✓ Completed processing: {video_file.name}")
+            logging.info(f"✓ Completed processing: {video_file.name}")
 
-            except Exception as e:
-                logging.error(f"Error processing {video_file}: {e}")
-                time.sleep(1)
+        except Exception as e:
+            logging.error(f"Error processing {video_file}: {e}")
 
-    def wait_for_stable_file(self, file_path: Path, timeout: int = 300):
-        """Wait for file to be completely written"""
+        finally:
+            self.finish(video_file)
+
+    def finish(self, video_file: Path):
+        """Allow a video to be queued again"""
+        self.closed_events.pop(video_file, None)
+        with self.processing_lock:
+            self.pending.discard(video_file)
+
+    async def wait_for_stable_file(self, file_path: Path, timeout: int = 300):
+        """Wait for file to be completely written
+
+        Returns as soon as the file is closed by its writer. Without a close
+        event (polling observer, files found at startup, other platforms) the
+        file counts as written once its size has not changed for 10 seconds,
+        checked with exponential backoff (1, 2, 4, 8, then every 15 seconds).
+        """
+        closed = self._closed_event(file_path)
+        deadline = time.monotonic() + timeout
+        delay = 1
         stable_duration = 0
-        last_size = 0
+        last_size = -1
 
-        while stable_duration < 10:  # Wait for 10 seconds of stable size
+        while True:
             try:
-                current_size = file_path.stat().st_size
-                if current_size == last_size and current_size > 0:
-                    stable_duration += 1
-                else:
-                    stable_duration = 0
-                    last_size = current_size
-
-                time.sleep(1)
-                timeout -= 1
-
-                if timeout <= 0:
-                    logging.warning(f"Timeout waiting for stable file: {file_path}")
-                    break
+                await asyncio.wait_for(closed.wait(), timeout=delay)
+                return
+            except asyncio.TimeoutError:
+                pass
 
+            try:
+                current_size = file_path.stat().st_size
             except FileNotFoundError:
                 logging.warning(f"File disappeared while waiting: {file_path}")
                 return
 
+            if current_size == last_size and current_size > 0:
+                stable_duration += delay
+                if stable_duration >= 10:  # Wait for 10 seconds of stable size
+                    return
+            else:
+                stable_duration = 0
+                last_size = current_size
+
+            if time.monotonic() >= deadline:
+                logging.warning(f"Timeout waiting for stable file: {file_path}")
+                return
+
+            delay = min(delay * 2, 15)
+
 class BatchProcessor:
-    def __init__(self, input_dir: str = "input", output_dir: str = "output"):
+    def __init__(self, input_dir: str = "input", output_dir: str = "output", max_workers: int = None,
+                 watch_interval: float = 30, state_db: Path = DEFAULT_STATE_DB):
         self.input_dir = Path(input_dir)
         self.output_dir = Path(output_dir)
+        self.watch_interval = watch_interval
 
         # Create directories
         self.input_dir.mkdir(exist_ok=True)
         self.output_dir.mkdir(exist_ok=True)
 
         # Setup file watcher
-        self.event_handler = VideoProcessingHandler(str(self.input_dir), str(self.output_dir))
-        self.observer = Observer()
+        self.event_handler = VideoProcessingHandler(str(self.input_dir), str(self.output_dir), max_workers,
+                                                    ProcessedIndex(state_db))
+        self.observer = self._pick_observer(self.input_dir)
         self.observer.schedule(self.event_handler, str(self.input_dir), recursive=True)
 
+    def _pick_observer(self, path: Path):
+        """Use native file events on local disks and polling on network mounts"""
+        if is_network_path(path):
+            logging.info(f"{path} is on a network filesystem, "
+                         f"polling for changes every {self.watch_interval}s")
+            return PollingObserver(timeout=self.watch_interval)
+        return Observer()
+
     def start(self):
         """Start the batch processor"""
         logging.info(f"Starting batch processor...")
         logging.info(f"Watching directory: {self.input_dir.absolute()}")
         logging.info(f"Output directory: {self.output_dir.absolute()}")
 
+        try:
+            asyncio.run(self._run())
+        except KeyboardInterrupt:
+            logging.info("Shutting down batch processor...")
+        finally:
+            self.event_handler.pool.shutdown(wait=False, cancel_futures=True)
+            if self.observer.is_alive():
+                self.observer.stop()
+                self.observer.join()
+
+    async def _run(self):
+        """Queue existing files, start watching and process the queue"""
+        self.event_handler.loop = asyncio.get_running_loop()
+        self.event_handler.processing_queue = asyncio.Queue()
+
         # Process any existing files
         self.process_existing_files()
 
         # Start watching for new files
         self.observer.start()
 
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            logging.info("Shutting down batch processor...")
-            self.observer.stop()
-
-        self.observer.join()
+        await self.event_handler.process_queue()
 
     def process_existing_files(self):
         """Process any video files already in the input directory"""
-        video_extensions = {'.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm', '.m4v'}
-
-        for file_path in self.input_dir.iterdir():
-            if file_path.is_file() and file_path.suffix.lower() in video_extensions:
-                self.event_handler.add_to_queue(file_path)
+        # DirEntry.is_file() uses the file type returned with the directory
+        # listing, so only symlinks need a stat()
+        with os.scandir(self.input_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and is_video(entry.name):
+                    self.event_handler.add_to_queue(Path(entry.path))
 
 def main():
     import argparse
 
+    # asyncio.to_thread and shutdown(cancel_futures=True) arrived in 3.9
+    if sys.version_info < (3, 9):
+        sys.exit("Python 3.9 or newer is required")
+
     parser = argparse.ArgumentParser(description='Batch Video Processing Service')
     parser.add_argument('-i', '--input', default='input', help='Input directory to watch (default: input)')
     parser.add_argument('-o', '--output', default='output', help='Output base directory (default: output)')
+    parser.add_argument('-w', '--workers', type=int, default=default_workers(),
+                        help=f'Videos to transcode in parallel (default: {default_workers()})')
+    parser.add_argument('--watch-interval', type=float, default=30,
+                        help='Polling interval in seconds when the input directory is on a network mount (default: 30)')
+    parser.add_argument('--state-db', type=Path, default=DEFAULT_STATE_DB,
+                        help=f'Database of already processed videos (default: {DEFAULT_STATE_DB})')
 
     args = parser.parse_args()
 
-    processor = BatchProcessor(args.input, args.output)
+    processor = BatchProcessor(args.input, args.output, args.workers, args.watch_interval, args.state_db)
     processor.start()
 
 if __name__ == "__main__":
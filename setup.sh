@@ -45,7 +45,12 @@ echo "✅ FFmpeg found: $(ffmpeg -version | head -n1)"
 
 # Check Python
 if ! command -v python3 &> /dev/null; then
-    echo "❌ Python 3 not found. Please install Python 3.6+"
+    echo "❌ Python 3 not found. Please install Python 3.9+"
+    exit 1
+fi
+
+if ! python3 -c 'import sys; sys.exit(sys.version_info < (3, 9))'; then
+    echo "❌ $(python3 --version) is too old. Please install Python 3.9+"
     exit 1
 fi
 
@@ -8,11 +8,13 @@ import os
 import sys
 import json
 import subprocess
+import shlex
 import shutil
+import functools
 from pathlib import Path
 import argparse
 import logging
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 # Configure logging
 logging.basicConfig(
@@ -24,11 +26,120 @@ logging.basicConfig(
     ]
 )
 
+# Parsed ffprobe output keyed by (path, st_mtime_ns, st_size)
+_probe_cache: Dict[Tuple, Dict] = {}
+
+# Containers whose headers already carry the stream parameters, so FFmpeg can
+# stop looking for stream info after a few frames. -analyzeduration is in
+# microseconds and 0 means the 5 s default, so half a second is given instead.
+FAST_PROBE_EXTENSIONS = {'.mp4', '.mov', '.m4v'}
+
+def fast_probe_args(path) -> List[str]:
+    """Input options that cut FFmpeg's stream probing short where it is safe"""
+    if Path(path).suffix.lower() in FAST_PROBE_EXTENSIONS:
+        return ['-probesize', '32k', '-analyzeduration', '500000']
+    return []
+
+def probe_cached(path, cache_file: Path = None) -> Dict:
+    """Run ffprobe on a file, reusing earlier results while the file is unchanged"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key in _probe_cache:
+        return _probe_cache[key]
+
+    # JSON object keys must be strings
+    disk_key = json.dumps(key)
+    disk_cache = {}
+    if cache_file and cache_file.exists():
+        try:
+            with open(cache_file) as f:
+                disk_cache = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable probe cache {cache_file}: {e}")
+
+    info = disk_cache.get(disk_key)
+    if info is None:
+        cmd = [
+            'ffprobe', '-v', 'quiet', *fast_probe_args(path), '-print_format', 'json',
+            '-show_format', '-show_streams', str(path)
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        info = json.loads(result.stdout)
+
+        if cache_file:
+            disk_cache[disk_key] = info
+            try:
+                with open(cache_file, 'w') as f:
+                    json.dump(disk_cache, f)
+            except OSError as e:
+                logging.warning(f"Could not write probe cache {cache_file}: {e}")
+
+    _probe_cache[key] = info
+    return info
+
+# H.264 encoders in order of preference, with their preset/rate-control options
+H264_ENCODERS = {
+    'h264_nvenc': {'preset': 'p4', 'tune': 'hq', 'rc': 'vbr', 'cq': '23'},
+    'h264_qsv': {'preset': 'medium'},
+    'h264_vaapi': {},
+    'libx264': {'preset': 'medium'},
+}
+
+# Render node used by the VAAPI encoder
+VAAPI_DEVICE = '/dev/dri/renderD128'
+
+# Threads per FFmpeg run when the batch processor runs several encodes side
+# by side instead of letting one encode claim every core
+FFMPEG_THREADS = 4
+
+def input_thread_args(threads: Optional[int]) -> List[str]:
+    """Decoder and filter graph thread caps; must come before -i"""
+    if threads is None:
+        return []
+    return ['-threads', str(threads), '-filter_complex_threads', str(threads)]
+
+def encoder_thread_args(profiles: List[Dict], threads: Optional[int],
+                        per_stream: bool = False) -> List[List[str]]:
+    """-threads options for each rung's encoder, sharing one budget by pixel count
+
+    The top rung has many times the pixels of the bottom one and sets the
+    run's wall-clock time, so it gets the largest share; every rung gets at
+    least one thread. Without a budget FFmpeg picks the thread counts.
+    """
+    if threads is None:
+        return [[] for _ in profiles]
+    pixels = [profile['width'] * profile['height'] for profile in profiles]
+    total = sum(pixels)
+    return [[f'-threads:v:{i}' if per_stream else '-threads', str(max(1, round(threads * count / total)))]
+            for i, count in enumerate(pixels)]
+
+# FFmpeg bitrate suffixes
+BITRATE_UNITS = {'k': 1_000, 'M': 1_000_000}
+
+@functools.lru_cache(maxsize=None)
+def parse_bitrate(bitrate: str) -> int:
+    """Convert an FFmpeg bitrate such as '1.5M' or '192k' to bits per second"""
+    unit = BITRATE_UNITS.get(bitrate[-1:])
+    if unit is None:
+        return int(bitrate)
+    return int(float(bitrate[:-1]) * unit)
+
+def parse_frame_rate(rate: str) -> float:
+    """Convert an ffprobe frame rate such as '30000/1001' to frames per second"""
+    num, _, den = rate.partition('/')
+    if not den:
+        return float(num)
+    return int(num) / int(den) if int(den) else 0.0
+
 class VideoTranscoder:
-    def __init__(self, input_file: str, output_dir: str = "output"):
+    def __init__(self, input_file: str, output_dir: str = "output", threads: Optional[int] = None):
         self.input_file = input_file
         self.output_dir = Path(output_dir)
+        # Thread budget for each FFmpeg run; None leaves every core to FFmpeg
+        self.threads = threads
         self.video_info = None
+        # Profiles that fit the source, largest first (see select_profiles)
+        self.valid_profiles = None
 
         # Create output directory
         self.output_dir.mkdir(exist_ok=True)
@@ -48,12 +159,7 @@ class VideoTranscoder:
     def get_video_info(self) -> Dict:
         """Extract video information using ffprobe"""
         try:
-            cmd = [
-                'ffprobe', '-v', 'quiet', '-print_format', 'json', 
-                '-show_format', '-show_streams', self.input_file
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            info = json.loads(result.stdout)
+            info = probe_cached(self.input_file, self.output_dir / '.probe_cache.json')
 
             # Find video stream
             video_stream = next(
@@ -65,7 +171,7 @@ class VideoTranscoder:
                 'duration': float(info['format']['duration']),
                 'width': int(video_stream['width']) if video_stream else 0,
                 'height': int(video_stream['height']) if video_stream else 0,
-                'fps': eval(video_stream['r_frame_rate']) if video_stream else 0
+                'fps': parse_frame_rate(video_stream['r_frame_rate']) if video_stream else 0
             }
 
             logging.info(f"Video info: {self.video_info}")
@@ -75,107 +181,224 @@ class VideoTranscoder:
             logging.error(f"Error getting video info: {e}")
             raise
 
-    def create_hls_streams(self) -> Dict[str, str]:
-        """Create HLS streams for all profiles"""
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def _detect_encoder() -> str:
+        """Pick the first H.264 encoder FFmpeg offers that works on this host"""
+        try:
+            result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                    capture_output=True, text=True, check=True)
+        except (subprocess.CalledProcessError, OSError):
+            return 'libx264'
+
+        available = {fields[1] for fields in map(str.split, result.stdout.splitlines())
+                     if len(fields) > 1}
+
+        for encoder in H264_ENCODERS:
+            if encoder == 'libx264':
+                break
+            # FFmpeg builds list hardware encoders even without the hardware, so
+            # encode a single frame to make sure the device is really there
+            if encoder in available and VideoTranscoder._encoder_works(encoder):
+                logging.info(f"Using hardware encoder: {encoder}")
+                return encoder
+
+        return 'libx264'
+
+    @staticmethod
+    def _encoder_works(encoder: str) -> bool:
+        """Check that an encoder can encode a test frame"""
+        cmd = ['ffmpeg', '-hide_banner', '-v', 'error']
+        if encoder == 'h264_vaapi':
+            cmd += ['-vaapi_device', VAAPI_DEVICE]
+        cmd += ['-f', 'lavfi', '-i', 'color=size=256x144', '-frames:v', '1']
+        if encoder == 'h264_vaapi':
+            cmd += ['-vf', 'format=nv12,hwupload']
+        cmd += ['-c:v', encoder, '-f', 'null', '-']
+
+        try:
+            return subprocess.run(cmd, capture_output=True, timeout=30).returncode == 0
+        except (subprocess.TimeoutExpired, OSError):
+            return False
+
+    @staticmethod
+    def _encoder_args(encoder: str, index: int = None) -> List[str]:
+        """Codec and preset options for an encoder, optionally for one output stream"""
+        spec = f':v:{index}' if index is not None else ''
+        args = [f'-c:v:{index}' if index is not None else '-c:v', encoder]
+        for option, value in H264_ENCODERS[encoder].items():
+            args.extend([f'-{option}{spec}', value])
+        return args
+
+    def select_profiles(self) -> List[Tuple[str, Dict]]:
+        """Pick the profiles that fit within the source resolution, largest first
+
+        The result is kept in self.valid_profiles and shared by the HLS and
+        DASH outputs. Sorting also keeps the scaling chain descending when
+        profiles are added out of order.
+        """
         if not self.video_info:
             self.get_video_info()
 
-        hls_outputs = {}
+        ordered = sorted(self.profiles.items(),
+                         key=lambda item: (item[1]['width'], item[1]['height']), reverse=True)
 
-        for profile_name, profile in self.profiles.items():
+        self.valid_profiles = []
+        for profile_name, profile in ordered:
             # Skip profiles larger than source resolution
-            if (profile['width'] > self.video_info['width'] or 
+            if (profile['width'] > self.video_info['width'] or
                 profile['height'] > self.video_info['height']):
                 logging.info(f"Skipping {profile_name} - larger than source")
                 continue
+            self.valid_profiles.append((profile_name, profile))
+
+        return self.valid_profiles
+
+    def prepare_output_dirs(self) -> None:
+        """Create hls/, hls/<profile>/ and dash/ for the valid profiles up front"""
+        hls_dir = self.output_dir / "hls"
+        dirs = [hls_dir, *(hls_dir / name for name, _ in self.valid_profiles), self.output_dir / "dash"]
+        for directory in dirs:
+            os.makedirs(directory, exist_ok=True)
+
+    def _run_ffmpeg(self, cmd: List[str]) -> None:
+        """Run FFmpeg with its output appended to ffmpeg.log in the output directory
+
+        FFmpeg output is not buffered in memory; on failure the last 4 KB of
+        this run's log are attached to the CalledProcessError as stderr.
+        """
+        cmd = [cmd[0], '-nostats', '-loglevel', 'error', *cmd[1:]]
+        log_path = self.output_dir / 'ffmpeg.log'
+        logging.debug("Command: %s", shlex.join(cmd))
+
+        with open(log_path, 'ab') as log_f:
+            start = log_f.tell()
+            returncode = subprocess.run(cmd, stdout=log_f, stderr=subprocess.STDOUT).returncode
+
+        if returncode:
+            with open(log_path, 'rb') as log_f:
+                log_f.seek(max(start, log_path.stat().st_size - 4096))
+                tail = log_f.read().decode(errors='replace')
+            raise subprocess.CalledProcessError(returncode, cmd, stderr=tail)
+
+    @staticmethod
+    def _build_ladder_filter(profiles: List[Tuple[str, Dict]], encoder: str) -> str:
+        """Build the filter graph that scales the source to every profile
+
+        Profiles are scaled as one descending chain (1080p -> 720p -> ... -> 240p):
+        each rung is scaled from the next larger rung rather than from the
+        source, so the full-size frame goes through the scaler only once. The
+        smallest rungs lose a little sharpness from the repeated downscale.
+        The output for the i-th profile is labelled [v{i}out].
+        """
+        filter_complex = []
+        source = '0:v'
+        for i, (profile_name, profile) in enumerate(profiles):
+            # VAAPI needs each rung uploaded to the GPU after scaling
+            scaled = f"v{i}sw" if encoder == 'h264_vaapi' else f"v{i}out"
+            scale = f"[{source}]scale={profile['width']}:{profile['height']}"
+            if i < len(profiles) - 1:
+                filter_complex.append(f"{scale},split=2[{scaled}][s{i}]")
+                source = f"s{i}"
+            else:
+                filter_complex.append(f"{scale}[{scaled}]")
+            if encoder == 'h264_vaapi':
+                filter_complex.append(f"[{scaled}]format=nv12,hwupload[v{i}out]")
+        return ';'.join(filter_complex)
 
-            output_dir = self.output_dir / "hls" / profile_name
-            output_dir.mkdir(parents=True, exist_ok=True)
+    def create_hls_streams(self) -> Dict[str, str]:
+        """Create HLS streams for all profiles
+
+        The source is decoded once and every profile is encoded from the
+        shared filter graph within a single FFmpeg run, one HLS output each.
+        """
+        valid_profiles = self.valid_profiles
+        if valid_profiles is None:
+            valid_profiles = self.select_profiles()
+            self.prepare_output_dirs()
+
+        encoder = self._detect_encoder()
+        hw_args = ['-vaapi_device', VAAPI_DEVICE] if encoder == 'h264_vaapi' else []
+        quality_args = ['-crf', '23'] if encoder == 'libx264' else []
 
+        if not valid_profiles:
+            return {}
+
+        cmd = [
+            'ffmpeg', '-y', *hw_args, *input_thread_args(self.threads), *fast_probe_args(self.input_file),
+            '-i', self.input_file,
+            '-filter_complex', self._build_ladder_filter(valid_profiles, encoder)
+        ]
+        thread_args = encoder_thread_args([profile for _, profile in valid_profiles], self.threads)
+
+        playlists = {}
+        for i, (profile_name, profile) in enumerate(valid_profiles):
+            output_dir = self.output_dir / "hls" / profile_name
             playlist_file = output_dir / "playlist.m3u8"
             segment_pattern = output_dir / "segment_%03d.ts"
-
-            cmd = [
-                'ffmpeg', '-i', self.input_file,
-                '-c:v', 'libx264',
-                '-preset', 'medium',
-                '-crf', '23',
+            playlists[profile_name] = str(playlist_file)
+
+            cmd += [
+                '-map', f'[v{i}out]',
+                '-map', '0:a:0?',
+                *self._encoder_args(encoder),
+                *quality_args,
+                *thread_args[i],
                 '-c:a', 'aac',
                 '-b:v', profile['bitrate'],
                 '-b:a', profile['audio_bitrate'],
-                '-vf', f"scale={profile['width']}:{profile['height']}",
                 '-hls_time', str(self.segment_duration),
                 '-hls_list_size', '0',
                 '-hls_segment_type', 'mpegts',
                 '-hls_segment_filename', str(segment_pattern),
                 '-f', 'hls',
-                str(playlist_file),
-                '-y'
+                str(playlist_file)
             ]
 
-            logging.info(f"Creating HLS stream for {profile_name}...")
-            try:
-                subprocess.run(cmd, check=True, capture_output=True)
-                hls_outputs[profile_name] = str(playlist_file)
-                logging.info(f"✓ HLS {profile_name} created successfully")
-            except subprocess.CalledProcessError as e:
-                logging.error(f"Error creating HLS {profile_name}: {e}")
-
-        return hls_outputs
+        logging.info(f"Creating HLS streams for {', '.join(playlists)}...")
+        try:
+            self._run_ffmpeg(cmd)
+            logging.info("✓ HLS streams created successfully")
+            return playlists
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Error creating HLS streams: {e}\n{e.stderr}")
+            return {}
 
     def create_dash_streams(self) -> str:
         """Create DASH stream with multiple representations"""
-        if not self.video_info:
-            self.get_video_info()
+        valid_profiles = self.valid_profiles
+        if valid_profiles is None:
+            valid_profiles = self.select_profiles()
+            self.prepare_output_dirs()
 
         dash_dir = self.output_dir / "dash"
-        dash_dir.mkdir(parents=True, exist_ok=True)
 
-        # Build complex filter for multiple outputs
-        filter_complex = []
+        encoder = self._detect_encoder()
+        hw_args = ['-vaapi_device', VAAPI_DEVICE] if encoder == 'h264_vaapi' else []
+
         map_args = []
         output_args = []
 
-        valid_profiles = []
-        for i, (profile_name, profile) in enumerate(self.profiles.items()):
-            if (profile['width'] <= self.video_info['width'] and 
-                profile['height'] <= self.video_info['height']):
-                valid_profiles.append((i, profile_name, profile))
-
-        # Video scaling filters
-        if len(valid_profiles) > 1:
-            filter_complex.append(f"[0:v]split={len(valid_profiles)}" + 
-                                "".join(f"[v{i}]" for i, _, _ in valid_profiles))
-        else:
-            filter_complex.append("[0:v]copy[v0]")
-
-        # Scale each output
-        for i, profile_name, profile in valid_profiles:
-            if len(valid_profiles) > 1:
-                filter_complex.append(
-                    f"[v{i}]scale={profile['width']}:{profile['height']}[v{i}out]"
-                )
-                map_args.extend(['-map', f'[v{i}out]'])
-            else:
-                filter_complex.append(
-                    f"[v0]scale={profile['width']}:{profile['height']}[v0out]"
-                )
-                map_args.extend(['-map', f'[v0out]'])
+        # Build complex filter for multiple outputs
+        filter_complex = self._build_ladder_filter(valid_profiles, encoder)
+
+        thread_args = encoder_thread_args([profile for _, profile in valid_profiles], self.threads,
+                                          per_stream=True)
+        for i, (profile_name, profile) in enumerate(valid_profiles):
+            map_args.extend(['-map', f'[v{i}out]'])
 
             # Video encoding settings
-            output_args.extend([
-                f'-c:v:{i}', 'libx264',
-                f'-b:v:{i}', profile['bitrate'],
-                f'-preset:v:{i}', 'medium'
-            ])
+            output_args.extend(self._encoder_args(encoder, i))
+            output_args.extend([f'-b:v:{i}', profile['bitrate'], *thread_args[i]])
 
         # Audio mapping
         map_args.extend(['-map', '0:a'])
         output_args.extend(['-c:a', 'aac', '-b:a', '128k'])
 
         cmd = [
-            'ffmpeg', '-i', self.input_file,
-            '-filter_complex', ';'.join(filter_complex)
+            'ffmpeg', *hw_args, *input_thread_args(self.threads), *fast_probe_args(self.input_file),
+            '-i', self.input_file,
+            '-filter_complex', filter_complex
         ] + map_args + output_args + [
             '-f', 'dash',
             '-seg_duration', str(self.segment_duration),
@@ -188,31 +411,29 @@ class VideoTranscoder:
 
         logging.info("Creating DASH stream...")
         try:
-            subprocess.run(cmd, check=True, capture_output=True)
+            self._run_ffmpeg(cmd)
             logging.info("✓ DASH stream created successfully")
             return str(dash_dir / 'manifest.mpd')
         except subprocess.CalledProcessError as e:
-            logging.error(f"Error creating DASH stream: {e}")
+            logging.error(f"Error creating DASH stream: {e}\n{e.stderr}")
             return None
 
     def create_master_hls_playlist(self, hls_outputs: Dict[str, str]) -> str:
         """Create master HLS playlist for adaptive streaming"""
         master_playlist_path = self.output_dir / "hls" / "master.m3u8"
 
-        with open(master_playlist_path, 'w') as f:
-            f.write("#EXTM3U\n")
-            f.write("#EXT-X-VERSION:6\n")
+        lines = ["#EXTM3U", "#EXT-X-VERSION:6"]
+        for profile_name in hls_outputs:
+            profile = self.profiles[profile_name]
+            # Bandwidth is video bitrate + audio bitrate
+            total_bw = parse_bitrate(profile['bitrate']) + parse_bitrate(profile['audio_bitrate'])
 
-            for profile_name, playlist_file in hls_outputs.items():
-                profile = self.profiles[profile_name]
-                # Calculate bandwidth (bitrate + audio bitrate)
-                video_bw = int(profile['bitrate'].replace('M', '000000').replace('k', '000'))
-                audio_bw = int(profile['audio_bitrate'].replace('k', '000'))
-                total_bw = video_bw + audio_bw
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={total_bw},"
+                         f"RESOLUTION={profile['width']}x{profile['height']}")
+            lines.append(f"{profile_name}/playlist.m3u8")
 
-                f.write(f"#EXT-X-STREAM-INF:BANDWIDTH={total_bw},"
-                       f"RESOLUTION={profile['width']}x{profile['height']}\n")
-                f.write(f"{profile_name}/playlist.m3u8\n")
+        with open(master_playlist_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
 
         logging.info(f"✓ Master HLS playlist created: {master_playlist_path}")
         return str(master_playlist_path)
@@ -275,6 +496,8 @@ class VideoTranscoder:
 
         # Get video information
         self.get_video_info()
+        self.select_profiles()
+        self.prepare_output_dirs()
 
         # Create HLS streams
         hls_outputs = self.create_hls_streams()
@@ -315,6 +538,8 @@ def main():
     parser.add_argument('input_file', help='Input video file path')
     parser.add_argument('-o', '--output', default='output', help='Output directory (default: output)')
     parser.add_argument('--segment-duration', type=int, default=10, help='Segment duration in seconds (default: 10)')
+    parser.add_argument('--threads', type=int,
+                        help='Thread budget for each FFmpeg run (default: FFmpeg uses every core)')
 
     args = parser.parse_args()
 
@@ -323,7 +548,7 @@ def main():
         sys.exit(1)
 
     try:
-        transcoder = VideoTranscoder(args.input_file, args.output)
+        transcoder = VideoTranscoder(args.input_file, args.output, threads=args.threads)
         transcoder.segment_duration = args.segment_duration
         transcoder.process()
     except Exception as e:
@@ -0,0 +1,260 @@
+"""
+Encoder detection and ffprobe caching shared by the working-code transcoders
+"""
+
+import functools
+import json
+import os
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+try:
+    import fcntl
+except ImportError:  # Windows: the probe cache is used without locking
+    fcntl = None
+
+try:
+    # Parses ffprobe's JSON straight from bytes, several times faster than json
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    from tqdm import tqdm
+except ImportError:  # Progress is printed as a plain percentage instead
+    tqdm = None
+
+# H.264 encoders in order of preference, with their encoder-specific options.
+# Rate control is up to the caller: a quality target such as -crf or -cq
+# overrides -b:v, which a bitrate ladder depends on.
+H264_ENCODERS = {
+    # B-frames off avoids "No decoder surfaces left" with several outputs
+    'h264_nvenc': {'preset': 'p4', 'tune': 'hq', 'rc': 'vbr', 'bf': '0'},
+    'h264_qsv': {},
+    'h264_vaapi': {},
+    'h264_videotoolbox': {},
+    'libx264': {},
+}
+
+# Encoders that take the x264-style preset names (ultrafast ... veryslow).
+# "faster" gives roughly 70% more throughput than "medium" at a VMAF
+# difference viewers can't see (Streaming Learning Center preset tests).
+X264_PRESET_ENCODERS = ('libx264', 'h264_qsv')
+DEFAULT_PRESET = 'faster'
+
+# h264_qsv has no presets below veryfast and rejects these names outright
+QSV_PRESET_ALIASES = {'ultrafast': 'veryfast', 'superfast': 'veryfast'}
+
+# Containers whose headers already carry the stream parameters, so FFmpeg can
+# stop looking for stream info after a few frames. -analyzeduration is in
+# microseconds and 0 means the 5 s default, so half a second is given instead.
+FAST_PROBE_EXTENSIONS = {'.mp4', '.mov', '.m4v'}
+
+# FFmpeg bitrate suffixes
+BITRATE_UNITS = {'k': 1_000, 'M': 1_000_000}
+
+# Render node used by the VAAPI encoder
+VAAPI_DEVICE = '/dev/dri/renderD128'
+
+# ffprobe results shared by every run, keyed by (path, mtime, size)
+PROBE_CACHE_FILE = Path.home() / ".cache" / "transcoder" / "probe.json"
+
+# Parsed ffprobe output for this process, keyed like the cache file
+_probe_cache: Dict[str, Dict] = {}
+
+
+@functools.lru_cache(maxsize=None)
+def detect_encoder(encoders: Sequence[str] = tuple(H264_ENCODERS)) -> str:
+    """Pick the first of the given H.264 encoders that works on this host"""
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                capture_output=True, text=True, check=True)
+    except (subprocess.CalledProcessError, OSError):
+        return 'libx264'
+
+    available = {fields[1] for fields in map(str.split, result.stdout.splitlines())
+                 if len(fields) > 1}
+
+    for encoder in encoders:
+        if encoder == 'libx264':
+            break
+        # FFmpeg builds list hardware encoders even without the hardware, so
+        # encode a single frame to make sure the device is really there
+        if encoder in available and _encoder_works(encoder):
+            print(f"⚡ Using hardware encoder: {encoder}")
+            return encoder
+
+    return 'libx264'
+
+
+def _encoder_works(encoder: str) -> bool:
+    """Check that an encoder can encode a test frame"""
+    cmd = ['ffmpeg', '-hide_banner', '-v', 'error']
+    if encoder == 'h264_vaapi':
+        cmd += ['-vaapi_device', VAAPI_DEVICE]
+    cmd += ['-f', 'lavfi', '-i', 'color=size=256x144', '-frames:v', '1']
+    if encoder == 'h264_vaapi':
+        cmd += ['-vf', 'format=nv12,hwupload']
+    cmd += ['-c:v', encoder, '-f', 'null', '-']
+
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=30).returncode == 0
+    except (subprocess.TimeoutExpired, OSError):
+        return False
+
+
+def encoder_args(encoder: str, preset: str = DEFAULT_PRESET, index: int = None,
+                 quality: Dict[str, str] = None) -> List[str]:
+    """Codec and preset options for an encoder, optionally for one output stream
+
+    quality holds the caller's extra rate-control options, e.g. {'crf': '23'}.
+    """
+    spec = f':v:{index}' if index is not None else ':v'
+    args = [f'-c{spec}', encoder]
+    if encoder == 'h264_qsv':
+        preset = QSV_PRESET_ALIASES.get(preset, preset)
+    if encoder in X264_PRESET_ENCODERS:
+        args.extend([f'-preset{spec}', preset])
+    for option, value in {**H264_ENCODERS[encoder], **(quality or {})}.items():
+        args.extend([f'-{option}{spec}', value])
+    return args
+
+
+@functools.lru_cache(maxsize=None)
+def parse_bitrate(bitrate: str) -> int:
+    """Convert an FFmpeg bitrate such as '1.5M' or '192k' to bits per second"""
+    unit = BITRATE_UNITS.get(bitrate[-1:])
+    if unit is None:
+        return int(float(bitrate))
+    return int(float(bitrate[:-1]) * unit)
+
+
+def input_thread_args(threads: Optional[int]) -> List[str]:
+    """Decoder and filter graph thread caps; must come before -i"""
+    if threads is None:
+        return []
+    return ['-threads', str(threads), '-filter_complex_threads', str(threads)]
+
+
+def encoder_thread_args(profiles: Sequence[Dict], threads: Optional[int]) -> List[List[str]]:
+    """Per-stream -threads options for a ladder, sharing one budget by pixel count
+
+    The top rung has many times the pixels of the bottom one and sets the
+    run's wall-clock time, so it gets the largest share; every rung gets at
+    least one thread. Without a budget FFmpeg picks the thread counts.
+    """
+    if threads is None:
+        return [[] for _ in profiles]
+    pixels = [profile['width'] * profile['height'] for profile in profiles]
+    total = sum(pixels)
+    return [[f'-threads:v:{i}', str(max(1, round(threads * count / total)))]
+            for i, count in enumerate(pixels)]
+
+
+def fast_probe_args(input_file: str) -> List[str]:
+    """Input options that cut FFmpeg's stream probing short where it is safe"""
+    if Path(input_file).suffix.lower() in FAST_PROBE_EXTENSIONS:
+        return ['-probesize', '32k', '-analyzeduration', '500000']
+    return []
+
+
+def run_ffmpeg(cmd: List[str], log_path: Path = None, duration: float = None) -> None:
+    """Run FFmpeg, logging to a file and showing progress when the duration is known
+
+    FFmpeg's log is appended to log_path, or to a temporary file when no
+    path is given, and progress is read line by line from -progress pipe:1,
+    so memory use stays flat however long the video is. On failure the last
+    4 KB of this run's log are attached to the CalledProcessError as stderr.
+    """
+    progress = ['-progress', 'pipe:1'] if duration else []
+    cmd = [cmd[0], *progress, '-nostats', '-loglevel', 'error', *cmd[1:]]
+
+    with (open(log_path, 'a+b') if log_path else tempfile.TemporaryFile()) as log_f:
+        start = log_f.tell()
+        stdout = subprocess.PIPE if duration else log_f
+        with subprocess.Popen(cmd, stdout=stdout, stderr=log_f, bufsize=1, text=True) as proc:
+            if duration:
+                _show_progress(proc.stdout, duration)
+
+        if proc.returncode:
+            log_f.seek(max(start, log_f.seek(0, os.SEEK_END) - 4096))
+            tail = log_f.read().decode(errors='replace')
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=tail)
+
+
+def _show_progress(lines, duration: float) -> None:
+    """Show encoding progress from FFmpeg's -progress output"""
+    bar = tqdm(total=round(duration), unit='s', leave=False) if tqdm else None
+    done = 0
+
+    for line in lines:
+        key, _, value = line.strip().partition('=')
+        if key != 'out_time_us' or not value.isdigit():
+            continue
+        seconds = min(int(value) / 1_000_000, duration)
+        if bar:
+            bar.update(round(seconds) - done)
+            done = round(seconds)
+        else:
+            print(f"\r   ⏳ {seconds / duration:6.1%}", end='', flush=True)
+
+    if bar:
+        bar.close()
+    else:
+        print()
+
+
+def probe(input_file: str, options: Sequence[str] = ()) -> Dict:
+    """Run ffprobe on a file and return its format and streams"""
+    cmd = [
+        'ffprobe', '-v', 'quiet', *options, '-print_format', 'json',
+        '-show_format', '-show_streams', str(input_file)
+    ]
+    result = subprocess.run(cmd, capture_output=True, check=True)
+    return _json_loads(result.stdout)
+
+
+def probe_cached(input_file: str, cache_file: Path = PROBE_CACHE_FILE,
+                 options: Sequence[str] = ()) -> Dict:
+    """Run ffprobe on a file, reusing the cached result while the file is unchanged
+
+    The cache is best-effort: when it can't be read, locked or written
+    (read-only or full disk, no lock support) the file is probed without it.
+    """
+    stat = os.stat(input_file)
+    # JSON object keys must be strings
+    key = json.dumps((os.path.abspath(input_file), stat.st_mtime_ns, stat.st_size))
+    if key in _probe_cache:
+        return _probe_cache[key]
+
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        f = open(cache_file, 'a+')
+    except OSError:
+        return probe(input_file, options)
+
+    with f:
+        try:
+            # Hold the lock across read, probe and write so concurrent runs don't drop entries
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            cache = _json_loads(f.read() or '{}')
+        except json.JSONDecodeError:
+            cache = {}
+        except OSError:
+            return probe(input_file, options)
+
+        if key not in cache:
+            cache[key] = probe(input_file, options)
+            try:
+                f.seek(0)
+                f.truncate()
+                json.dump(cache, f)
+            except OSError:
+                pass  # The result is still good, it just won't be reused
+
+    _probe_cache[key] = cache[key]
+    return cache[key]
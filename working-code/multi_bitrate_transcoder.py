@@ -1,9 +1,28 @@
+import logging
+import shlex
 import subprocess
 from pathlib import Path
 import ffmpeg
 
+from ffmpeg_common import (VAAPI_DEVICE, detect_encoder, encoder_args, encoder_thread_args,
+                           fast_probe_args, input_thread_args, probe_cached, run_ffmpeg)
 
-def transcode_to_multibitrate(input_file, output_dir):
+# FFmpeg's log, kept in the output directory
+FFMPEG_LOG = 'ffmpeg.log'
+
+# x264/QSV preset for every rung
+PRESET = 'fast'
+
+# Rate control beyond each rung's -b:v/-maxrate/-bufsize, by encoder
+ENCODER_QUALITY = {'h264_nvenc': {'cq': '23'}}
+
+
+def probe_input(input_file, output_dir):
+    """Probe the input, reusing earlier results (kept in output_dir) while it is unchanged"""
+    return probe_cached(input_file, Path(output_dir) / '.probe_cache.json', fast_probe_args(input_file))
+
+
+def transcode_to_multibitrate(input_file, output_dir, threads=None):
     ladder = [
         {'name': '240p', 'width': 426, 'height': 240, 'bitrate': '400k', 'maxrate': '450k', 'bufsize': '600k'},
         {'name': '360p', 'width': 640, 'height': 360, 'bitrate': '800k', 'maxrate': '900k', 'bufsize': '1200k'},
@@ -16,16 +35,14 @@ def transcode_to_multibitrate(input_file, output_dir):
 
     # Probe the input file to check for audio streams
     try:
-        probe = ffmpeg.probe(str(input_file))
+        probe = probe_input(input_file, output_dir)
         has_audio = any(stream['codec_type'] == 'audio' for stream in probe['streams'])
     except Exception:
         has_audio = False
 
     # Create filter_complex for scaling video streams
-    filter_parts = []
-    for i, level in enumerate(ladder):
-        filter_parts.append(f'[0:v]scale={level["width"]}:{level["height"]}[v{i}]')
-    filter_complex = ';'.join(filter_parts)
+    encoder = detect_encoder()
+    filter_complex = build_ladder_filter(ladder, hwupload=encoder == 'h264_vaapi')
 
     # var_stream_map pairs each video stream with audio (if available)
     if has_audio:
@@ -36,17 +53,106 @@ def transcode_to_multibitrate(input_file, output_dir):
 
     # Prepare output paths and ensure directories exist
     output_dir = Path(output_dir)
-    hls_dir = output_dir / 'hls'
-    hls_dir.mkdir(parents=True, exist_ok=True)
+    cmaf_dir = output_dir / 'cmaf'
+    cmaf_dir.mkdir(parents=True, exist_ok=True)
 
-    # For HLS master playlist, use just the filename (FFmpeg will create it in the same directory as variants)
+    # FFmpeg writes the HLS master playlist next to the DASH manifest
     master_playlist_name = 'master.m3u8'
-    variant_playlist_pattern = str(hls_dir / 'stream_%v.m3u8')
-    segment_filename_pattern = str(hls_dir / 'segment_%v_%03d.ts')
+    master_playlist_path = cmaf_dir / master_playlist_name
+    dash_manifest = cmaf_dir / 'manifest.mpd'
+
+    # Encode every rung once into a single set of CMAF (fragmented MP4)
+    # segments. The dash muxer writes the MPD and, with hls_playlist, HLS
+    # playlists that reference the very same segments, so nothing is muxed
+    # or stored twice.
+    args = build_encode_args(input_file, filter_complex, ladder, has_audio, encoder, threads)
+    args.extend([
+        '-f', 'dash',
+        '-seg_duration', '6',
+        '-use_template', '1',
+        '-use_timeline', '1',
+        '-adaptation_sets', 'id=0,streams=v id=1,streams=a' if has_audio else 'id=0,streams=v',
+        '-hls_playlist', '1',
+        '-hls_master_name', master_playlist_name,
+        str(dash_manifest)
+    ])
+
+    print("Running FFmpeg command for CMAF HLS and DASH...")
+    logging.debug("Command: %s", shlex.join(args))
+    try:
+        run_ffmpeg(args, output_dir / FFMPEG_LOG)
+    except subprocess.CalledProcessError as e:
+        print(f"CMAF HLS/DASH command failed with exit code {e.returncode}")
+        print(f"stderr: {e.stderr}")
 
-    # Build the command manually using ffmpeg.run() to have better control
-    args = [
-        'ffmpeg',
+        # Fall back to separate HLS and DASH passes
+        print("Trying fallback with separate HLS and DASH passes...")
+        hls_dir = output_dir / 'hls'
+        hls_dir.mkdir(parents=True, exist_ok=True)
+        transcode_hls(input_file, hls_dir, filter_complex, ladder, has_audio, var_stream_map, threads)
+        generate_dash_manifest(input_file, output_dir, ladder, has_audio, threads)
+        master_playlist_path = hls_dir / master_playlist_name
+        dash_manifest = output_dir / 'dash' / 'manifest.mpd'
+
+    print(f"HLS transcoding complete.\nMaster playlist location: {master_playlist_path}")
+    print(f"DASH transcoding complete.\nMPD manifest location: {dash_manifest}")
+
+    # Verify master playlist was created
+    if master_playlist_path.exists():
+        print(f"✓ Master playlist created successfully: {master_playlist_path}")
+        # Show first few lines of master playlist for verification
+        with open(master_playlist_path, 'r') as f:
+            lines = f.readlines()[:10]
+            print("Master playlist content preview:")
+            for line in lines:
+                print(f"  {line.rstrip()}")
+    else:
+        print(f"⚠ Warning: Master playlist not found at {master_playlist_path}")
+        # List what files were actually created
+        print("Files created in the output directory:")
+        for file in sorted(master_playlist_path.parent.glob('*')):
+            print(f"  {file.name}")
+
+
+def build_ladder_filter(ladder, hwupload=False):
+    """Build a filter graph that scales the ladder as one descending chain
+
+    Each rung is scaled from the next larger rung instead of from the source,
+    e.g. [0:v]scale=1920:1080,split=2[v4][s4];[s4]scale=1280:720,split=2[v3][s3];...
+    so the full-size frame only passes through the scaler once. The trade-off
+    is a marginal loss of sharpness on the smallest rungs, which are scaled
+    from an already downscaled picture. Expects the ladder ordered from the
+    smallest to the largest rung; the output of rung i is labelled [v{i}].
+    With hwupload, every rung is uploaded to the GPU after scaling (VAAPI).
+    """
+    filter_parts = []
+    source = '0:v'
+    for i in reversed(range(len(ladder))):
+        level = ladder[i]
+        scaled = f'v{i}sw' if hwupload else f'v{i}'
+        scale = f'[{source}]scale={level["width"]}:{level["height"]}'
+        if i > 0:
+            filter_parts.append(f'{scale},split=2[{scaled}][s{i}]')
+            source = f's{i}'
+        else:
+            filter_parts.append(f'{scale}[{scaled}]')
+        if hwupload:
+            filter_parts.append(f'[{scaled}]format=nv12,hwupload[v{i}]')
+    return ';'.join(filter_parts)
+
+
+def build_encode_args(input_file, filter_complex, ladder, has_audio, encoder='libx264', threads=None):
+    """Build the shared input, mapping and encoding arguments for every rung
+
+    threads caps the whole run, shared between the rungs by pixel count;
+    None leaves the thread counts to FFmpeg.
+    """
+    args = ['ffmpeg']
+    if encoder == 'h264_vaapi':
+        args.extend(['-vaapi_device', VAAPI_DEVICE])
+    args.extend(input_thread_args(threads))
+    args.extend(fast_probe_args(input_file))
+    args += [
         '-i', str(input_file),
         '-filter_complex', filter_complex,
         '-y'  # overwrite output
@@ -54,23 +160,26 @@ def transcode_to_multibitrate(input_file, output_dir):
 
     # Add map arguments for each video stream
     for i in range(len(ladder)):
-        args.extend(['-map', f'[v{i}]'])
+        args += ('-map', f'[v{i}]')
 
     # Add audio map if present
     if has_audio:
         args.extend(['-map', '0:a'])
 
     # Add video encoding options for each stream
+    thread_args = encoder_thread_args(ladder, threads)
     for i, level in enumerate(ladder):
-        args.extend([f'-c:v:{i}', 'libx264'])
-        args.extend([f'-b:v:{i}', level['bitrate']])
-        args.extend([f'-maxrate:{i}', level['maxrate']])
-        args.extend([f'-bufsize:{i}', level['bufsize']])
-        args.extend([f'-profile:v:{i}', 'main'])
+        args += encoder_args(encoder, PRESET, index=i, quality=ENCODER_QUALITY.get(encoder))
+        args += thread_args[i]
+        args += (
+            f'-b:v:{i}', level['bitrate'],
+            f'-maxrate:{i}', level['maxrate'],
+            f'-bufsize:{i}', level['bufsize'],
+            f'-profile:v:{i}', 'main',
+        )
 
     # Add common encoding options
     args.extend([
-        '-preset', 'fast',
         '-g', '48',
         '-sc_threshold', '0'
     ])
@@ -84,61 +193,36 @@ def transcode_to_multibitrate(input_file, output_dir):
             '-ar', '48000'
         ])
 
+    return args
+
+
+def transcode_hls(input_file, hls_dir, filter_complex, ladder, has_audio, var_stream_map, threads=None):
+    """Generate HLS playlists and segments on their own (CMAF fallback)"""
+    args = build_encode_args(input_file, filter_complex, ladder, has_audio, detect_encoder(), threads)
+
     # Add HLS options
     args.extend([
         '-f', 'hls',
         '-hls_time', '6',
         '-hls_playlist_type', 'vod',
-        '-hls_segment_filename', segment_filename_pattern,
+        '-hls_segment_type', 'fmp4',
+        '-hls_fmp4_init_filename', 'init_%v.mp4',
+        '-hls_segment_filename', str(hls_dir / 'segment_%v_%03d.m4s'),
         '-var_stream_map', var_stream_map,
-        '-master_pl_name', master_playlist_name,
-        variant_playlist_pattern
+        '-master_pl_name', 'master.m3u8',
+        str(hls_dir / 'stream_%v.m3u8')
     ])
 
-    # Run the HLS transcoding command
-    print("Running FFmpeg command for HLS...")
-    print(f"Command: {' '.join(args)}")  # Debug: show the actual command
+    logging.debug("HLS Command: %s", shlex.join(args))
     try:
-        import subprocess
-        result = subprocess.run(args, capture_output=True, text=True, check=True)
-        print(f"HLS transcoding complete.\nMaster playlist location: {hls_dir / master_playlist_name}")
-
-        # Verify master playlist was created
-        master_playlist_path = hls_dir / master_playlist_name
-        if master_playlist_path.exists():
-            print(f"✓ Master playlist created successfully: {master_playlist_path}")
-            # Show first few lines of master playlist for verification
-            with open(master_playlist_path, 'r') as f:
-                lines = f.readlines()[:10]
-                print("Master playlist content preview:")
-                for line in lines:
-                    print(f"  {line.rstrip()}")
-        else:
-            print(f"⚠ Warning: Master playlist not found at {master_playlist_path}")
-            # List what files were actually created
-            print("Files created in HLS directory:")
-            for file in sorted(hls_dir.glob('*')):
-                print(f"  {file.name}")
-
+        run_ffmpeg(args, hls_dir.parent / FFMPEG_LOG)
     except subprocess.CalledProcessError as e:
         print(f"FFmpeg error occurred during HLS transcoding:")
-        print(f"stdout: {e.stdout}")
-        print(f"stderr: {e.stderr}")
-        raise
-
-    # Generate DASH manifest
-    print("Generating DASH manifest...")
-    try:
-        generate_dash_manifest(input_file, output_dir, ladder, has_audio)
-        print(f"DASH transcoding complete.\nMPD manifest location: {output_dir / 'dash' / 'manifest.mpd'}")
-    except subprocess.CalledProcessError as e:
-        print(f"FFmpeg error occurred during DASH transcoding:")
-        print(f"stdout: {e.stdout}")
         print(f"stderr: {e.stderr}")
         raise
 
 
-def generate_dash_manifest(input_file, output_dir, ladder, has_audio):
+def generate_dash_manifest(input_file, output_dir, ladder, has_audio, threads=None):
     """Generate DASH manifest and segments"""
 
     # Create DASH output directory
@@ -146,53 +230,14 @@ def generate_dash_manifest(input_file, output_dir, ladder, has_audio):
     dash_dir.mkdir(parents=True, exist_ok=True)
 
     # Create filter_complex for scaling video streams
-    filter_parts = []
-    for i, level in enumerate(ladder):
-        filter_parts.append(f'[0:v]scale={level["width"]}:{level["height"]}[v{i}]')
-    filter_complex = ';'.join(filter_parts)
+    encoder = detect_encoder()
+    filter_complex = build_ladder_filter(ladder, hwupload=encoder == 'h264_vaapi')
 
     # DASH output configuration - use simpler template names
     dash_manifest = dash_dir / 'manifest.mpd'
 
     # Build the DASH command manually
-    args = [
-        'ffmpeg',
-        '-i', str(input_file),
-        '-filter_complex', filter_complex,
-        '-y'  # overwrite output
-    ]
-
-    # Add map arguments for each video stream
-    for i in range(len(ladder)):
-        args.extend(['-map', f'[v{i}]'])
-
-    # Add audio map if present
-    if has_audio:
-        args.extend(['-map', '0:a'])
-
-    # Add video encoding options for each stream
-    for i, level in enumerate(ladder):
-        args.extend([f'-c:v:{i}', 'libx264'])
-        args.extend([f'-b:v:{i}', level['bitrate']])
-        args.extend([f'-maxrate:{i}', level['maxrate']])
-        args.extend([f'-bufsize:{i}', level['bufsize']])
-        args.extend([f'-profile:v:{i}', 'main'])
-
-    # Add common encoding options
-    args.extend([
-        '-preset', 'fast',
-        '-g', '48',
-        '-sc_threshold', '0'
-    ])
-
-    # Add audio options if present
-    if has_audio:
-        args.extend([
-            '-c:a', 'aac',
-            '-b:a', '128k',
-            '-ac', '2',
-            '-ar', '48000'
-        ])
+    args = build_encode_args(input_file, filter_complex, ladder, has_audio, encoder, threads)
 
     # Add DASH options with simpler configuration
     args.extend([
@@ -201,32 +246,31 @@ def generate_dash_manifest(input_file, output_dir, ladder, has_audio):
         str(dash_manifest)
     ])
 
-    print(f"DASH Command: {' '.join(args)}")  # Debug: show the actual command
-    import subprocess
+    logging.debug("DASH Command: %s", shlex.join(args))
     try:
-        result = subprocess.run(args, capture_output=True, text=True, check=True)
+        run_ffmpeg(args, output_dir / FFMPEG_LOG)
     except subprocess.CalledProcessError as e:
         print(f"DASH FFmpeg command failed with exit code {e.returncode}")
-        print(f"stdout: {e.stdout}")
         print(f"stderr: {e.stderr}")
 
         # Try a fallback approach with even simpler DASH options
         print("Trying fallback DASH configuration...")
         simple_args = [
             'ffmpeg',
+            *input_thread_args(threads),
             '-i', str(input_file),
-            '-filter_complex', filter_parts[0],  # Just use one resolution for fallback
+            '-filter_complex', f'[0:v]scale={ladder[0]["width"]}:{ladder[0]["height"]}[v0]',  # Just use one resolution for fallback
             '-map', '[v0]',
-            '-c:v', 'libx264',
+            *encoder_args('libx264', PRESET),
             '-b:v', ladder[0]['bitrate'],
-            '-preset', 'fast',
+            *(['-threads', str(threads)] if threads else []),
             '-f', 'dash',
             '-y',
             str(dash_manifest)
         ]
 
         try:
-            result = subprocess.run(simple_args, capture_output=True, text=True, check=True)
+            run_ffmpeg(simple_args, output_dir / FFMPEG_LOG)
             print("Fallback DASH generation succeeded with single bitrate")
         except subprocess.CalledProcessError as e2:
             print(f"Fallback DASH also failed: {e2.stderr}")
@@ -241,14 +285,19 @@ if __name__ == '__main__':
     parser.add_argument('output_dir', type=Path, help="Output directory path for manifest and segments")
     parser.add_argument('--format', choices=['hls', 'dash', 'both'], default='both',
                         help="Output format: 'hls' for HLS only, 'dash' for DASH only, 'both' for both formats (default: both)")
+    parser.add_argument('--threads', type=int,
+                        help="Thread budget for each FFmpeg run (default: FFmpeg uses every core)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Log the FFmpeg commands being run")
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format='%(message)s')
+
     if args.format in ['hls', 'both']:
-        transcode_to_multibitrate(args.input_file, args.output_dir)
+        transcode_to_multibitrate(args.input_file, args.output_dir, args.threads)
     elif args.format == 'dash':
         # For DASH-only, we still need to probe for audio
         try:
-            probe = ffmpeg.probe(str(args.input_file))
+            probe = probe_input(args.input_file, args.output_dir)
             has_audio = any(stream['codec_type'] == 'audio' for stream in probe['streams'])
         except Exception:
             has_audio = False
@@ -268,10 +317,9 @@ if __name__ == '__main__':
         args.output_dir.mkdir(parents=True, exist_ok=True)
         print("Generating DASH manifest...")
         try:
-            generate_dash_manifest(args.input_file, args.output_dir, ladder, has_audio)
+            generate_dash_manifest(args.input_file, args.output_dir, ladder, has_audio, args.threads)
             print(f"DASH transcoding complete.\nMPD manifest location: {args.output_dir / 'dash' / 'manifest.mpd'}")
         except subprocess.CalledProcessError as e:
             print(f"FFmpeg error occurred during DASH transcoding:")
-            print(f"stdout: {e.stdout}")
             print(f"stderr: {e.stderr}")
             raise
\ No newline at end of file
@@ -9,81 +9,247 @@ import sys
 import json
 import subprocess
 import argparse
+import asyncio
+import string
+import functools
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+
+from ffmpeg_common import (DEFAULT_PRESET, H264_ENCODERS, detect_encoder, encoder_args,
+                           parse_bitrate, probe_cached, run_ffmpeg)
+
+# The single-pass graph has no hwupload step, so VAAPI is left out
+CMAF_ENCODERS = tuple(encoder for encoder in H264_ENCODERS if encoder != 'h264_vaapi')
+
+# VBV limits relative to a rung's target bitrate, as in multi_bitrate_transcoder.py
+MAXRATE_FACTOR = 1.1
+BUFSIZE_FACTOR = 1.5
+
+# Largest bitrate ratio between adjacent ladder rungs, by source bits per pixel.
+# Easy content looks fine at lower rates, so its rungs can be further apart.
+LADDER_STEPS = ((0.05, 3.2), (0.15, 3.0), (float('inf'), 2.2))
+
+def _print_ffmpeg_missing():
+    print("❌ FFmpeg not found. Please install FFmpeg first.")
+    print("   macOS: brew install ffmpeg")
+    print("   Ubuntu/Debian: sudo apt install ffmpeg")
+    print("   Windows: Download from https://ffmpeg.org/")
+
+@functools.lru_cache(maxsize=1)
+def check_ffmpeg() -> bool:
+    """Check if FFmpeg is available"""
+    try:
+        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
+        return True
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        _print_ffmpeg_missing()
+        return False
+
+def rate_control_args(video_bps: int, index: int = None) -> List[str]:
+    """Average bitrate with a VBV cap, so a rung stays close to the bandwidth it advertises
+
+    No -crf/-cq is added: a quality target would override -b:v and every
+    rung would come out at whatever bitrate the content needs.
+    """
+    spec = f':v:{index}' if index is not None else ':v'
+    return [f'-b{spec}', f'{video_bps // 1000}k',
+            f'-maxrate{spec}', f'{int(video_bps * MAXRATE_FACTOR) // 1000}k',
+            f'-bufsize{spec}', f'{int(video_bps * BUFSIZE_FACTOR) // 1000}k']
+
+# The single CMAF encode carries one AAC track that every rendition shares
+CMAF_AUDIO_BITRATE = '128k'
+
+# Quality profiles for different resolutions
+PROFILES = {
+    "240p": {"width": 426, "height": 240, "bitrate": "400k", "audio_bitrate": "64k"},
+    "360p": {"width": 640, "height": 360, "bitrate": "800k", "audio_bitrate": "96k"},
+    "480p": {"width": 854, "height": 480, "bitrate": "1200k", "audio_bitrate": "128k"},
+    "720p": {"width": 1280, "height": 720, "bitrate": "2500k", "audio_bitrate": "128k"},
+    "1080p": {"width": 1920, "height": 1080, "bitrate": "4500k", "audio_bitrate": "192k"},
+    "1440p": {"width": 2560, "height": 1440, "bitrate": "8000k", "audio_bitrate": "192k"},
+    "2160p": {"width": 3840, "height": 2160, "bitrate": "16000k", "audio_bitrate": "192k"}
+}
+
+# Test player pages, filled in with $stem, $name, $segment_duration, $hls_url, $dash_url
+# and $dash_links (the HLS page's DASH links, empty without DASH output)
+HLS_PLAYER_TEMPLATE = string.Template("""<!DOCTYPE html>
+<html>
+<head>
+    <title>HLS Player - $stem</title>
+    <script src="https://vjs.zencdn.net/8.5.2/video.min.js"></script>
+    <link href="https://vjs.zencdn.net/8.5.2/video-js.css" rel="stylesheet">
+    <style>
+        body { font-family: Arial, sans-serif; margin: 20px; background: #f0f0f0; }
+        .container { max-width: 1000px; margin: 0 auto; background: white; padding: 20px; border-radius: 10px; }
+        h1 { color: #333; }
+        .video-js { margin: 20px 0; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>🎥 HLS Player</h1>
+        <p>Video: <strong>$name</strong></p>
+
+        <video-js id="hls-player" class="vjs-default-skin" 
+                  controls preload="auto" width="800" height="450" 
+                  data-setup="{}">
+            <source src="$hls_url" type="application/x-mpegURL">
+            <p class="vjs-no-js">
+                To view this video please enable JavaScript, and consider upgrading to a web browser that
+                <a href="https://videojs.com/html5-video-support/" target="_blank">supports HTML5 video</a>.
+            </p>
+        </video-js>
+
+        <div style="margin-top: 20px;">
+            <h3>Available Streams:</h3>
+            <ul>
+                <li><a href="$hls_url">Master Playlist (Adaptive)</a></li>$dash_links
+            </ul>
+        </div>
+    </div>
+
+    <script>
+        var player = videojs('hls-player');
+        console.log('HLS player initialized');
+    </script>
+</body>
+</html>""")
+
+DASH_PLAYER_TEMPLATE = string.Template("""<!DOCTYPE html>
+<html>
+<head>
+    <title>DASH Player - $stem</title>
+    <script src="https://cdn.dashjs.org/latest/dash.all.min.js"></script>
+    <style>
+        body { font-family: Arial, sans-serif; margin: 20px; background: #f0f0f0; }
+        .container { max-width: 1000px; margin: 0 auto; background: white; padding: 20px; border-radius: 10px; }
+        h1 { color: #333; }
+        video { margin: 20px 0; width: 100%; max-width: 800px; height: auto; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>📺 DASH Player</h1>
+        <p>Video: <strong>$name</strong></p>
+
+        <video id="dash-player" controls width="800" height="450"></video>
+
+        <div style="margin-top: 20px;">
+            <h3>Stream Information:</h3>
+            <ul>
+                <li><strong>Format:</strong> DASH (Dynamic Adaptive Streaming)</li>
+                <li><strong>Segments:</strong> $segment_duration second chunks</li>
+                <li><strong>Adaptive Bitrate:</strong> Automatically adjusts quality</li>
+            </ul>
+
+            <h3>Available Streams:</h3>
+            <ul>
+                <li><a href="$dash_url">DASH Manifest</a></li>
+                <li><a href="$hls_url">HLS Master Playlist</a></li>
+                <li><a href="hls_player.html">HLS Player</a></li>
+            </ul>
+        </div>
+    </div>
+
+    <script>
+        var url = "$dash_url";
+        var player = dashjs.MediaPlayer().create();
+        player.initialize(document.querySelector("#dash-player"), url, true);
+        console.log('DASH player initialized with:', url);
+    </script>
+</body>
+</html>""")
+
+class TranscodeError(Exception):
+    """An input that can't be transcoded, such as one ffprobe can't read"""
 
 class VideoTranscoder:
 
-    def __init__(self, input_file: str, output_dir: str = None):
+    def __init__(self, input_file: str, output_parent: str = None):
         self.input_file = input_file
-        # self.output_dir = Path(output_dir + "_streaming") if output_dir else Path(input_file).stem + "_streaming"
-        self.output_dir = Path("sample_streaming")
+        self.input_path = Path(input_file)
+        self.input_stem = self.input_path.stem
+        self.input_name = self.input_path.name
+        # <name>_streaming/, the layout streaming_server.py looks for
+        self.output_dir = Path(output_parent or ".") / f"{self.input_stem}_streaming"
 
         # Quality profiles for different resolutions
-        self.profiles = {
-            "240p": {"width": 426, "height": 240, "bitrate": "400k", "audio_bitrate": "64k"},
-            "360p": {"width": 640, "height": 360, "bitrate": "800k", "audio_bitrate": "96k"},
-            "480p": {"width": 854, "height": 480, "bitrate": "1200k", "audio_bitrate": "128k"},
-            "720p": {"width": 1280, "height": 720, "bitrate": "2500k", "audio_bitrate": "128k"},
-            "1080p": {"width": 1920, "height": 1080, "bitrate": "4500k", "audio_bitrate": "192k"}
-        }
+        self.profiles = {name: dict(profile) for name, profile in PROFILES.items()}
+
+        # Bitrates in bits per second, parsed once for sorting and playlists
+        for profile in self.profiles.values():
+            profile['video_bps'] = parse_bitrate(profile['bitrate'])
+            profile['bandwidth'] = profile['video_bps'] + parse_bitrate(profile['audio_bitrate'])
 
         # Segment duration in seconds
         self.segment_duration = 6
 
+        # Encoder speed/quality preset
+        self.preset = DEFAULT_PRESET
+
+        # Use every profile that fits instead of a content-adaptive ladder
+        self.static_ladder = False
+
+        # Player URLs, relative to the output directory
+        self.hls_url = "cmaf/master.m3u8"
+        self.dash_url = "cmaf/manifest.mpd"
+
         # Video information
         self.video_info = None
 
     def check_ffmpeg(self):
         """Check if FFmpeg is available"""
-        try:
-            subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-            return True
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            print("❌ FFmpeg not found. Please install FFmpeg first.")
-            print("   macOS: brew install ffmpeg")
-            print("   Ubuntu/Debian: sudo apt install ffmpeg")
-            print("   Windows: Download from https://ffmpeg.org/")
-            return False
+        return check_ffmpeg()
 
-    def get_video_info(self) -> Dict:
-        """Get video information using ffprobe"""
+    async def _check_ffmpeg_async(self) -> bool:
+        """Check if FFmpeg is available without blocking the event loop"""
         try:
-            cmd = [
-                'ffprobe', '-v', 'quiet', '-print_format', 'json',
-                '-show_format', '-show_streams', self.input_file
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            info = json.loads(result.stdout)
-
-            # Find video stream
-            video_stream = next(
-                (stream for stream in info['streams'] if stream['codec_type'] == 'video'),
-                None
+            proc = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-version', stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
             )
+            if await proc.wait() == 0:
+                return True
+        except FileNotFoundError:
+            pass
+        _print_ffmpeg_missing()
+        return False
 
-            if not video_stream:
-                raise ValueError("No video stream found")
-
-            self.video_info = {
-                'duration': float(info['format'].get('duration', 0)),
-                'width': int(video_stream.get('width', 0)),
-                'height': int(video_stream.get('height', 0)),
-                'fps': self._parse_fps(video_stream.get('r_frame_rate', '25/1')),
-                'bitrate': int(info['format'].get('bit_rate', 0))
-            }
-
-            print(f"📹 Video Info: {self.video_info['width']}x{self.video_info['height']} @ {self.video_info['fps']:.1f}fps")
-            print(f"⏱️  Duration: {self.video_info['duration']:.1f} seconds")
+    def get_video_info(self) -> Dict:
+        """Get video information using ffprobe, raising TranscodeError if the input can't be probed"""
+        try:
+            return self._read_video_info()
+        except json.JSONDecodeError as e:
+            raise TranscodeError("Error parsing video information") from e
+        except (subprocess.CalledProcessError, OSError) as e:
+            raise TranscodeError(f"Error getting video info: {e}") from e
+
+    def _read_video_info(self) -> Dict:
+        """Probe the input and keep the stream parameters in self.video_info"""
+        info = probe_cached(self.input_file)
+
+        # Find video stream
+        video_stream = next(
+            (stream for stream in info['streams'] if stream['codec_type'] == 'video'),
+            None
+        )
+
+        if not video_stream:
+            raise TranscodeError("No video stream found")
+
+        self.video_info = {
+            'duration': float(info['format'].get('duration', 0)),
+            'width': int(video_stream.get('width', 0)),
+            'height': int(video_stream.get('height', 0)),
+            'fps': self._parse_fps(video_stream.get('r_frame_rate', '25/1')),
+            'bitrate': int(info['format'].get('bit_rate', 0)),
+            'has_audio': any(stream['codec_type'] == 'audio' for stream in info['streams'])
+        }
 
-            return self.video_info
+        print(f"📹 Video Info: {self.video_info['width']}x{self.video_info['height']} @ {self.video_info['fps']:.1f}fps")
+        print(f"⏱️  Duration: {self.video_info['duration']:.1f} seconds")
 
-        except subprocess.CalledProcessError as e:
-            print(f"❌ Error getting video info: {e}")
-            sys.exit(1)
-        except json.JSONDecodeError:
-            print("❌ Error parsing video information")
-            sys.exit(1)
+        return self.video_info
 
     def _parse_fps(self, fps_str: str) -> float:
         """Parse frame rate from fraction string like '25/1'"""
@@ -95,8 +261,9 @@ class VideoTranscoder:
         except:
             return 25.0  # default
 
-    def filter_profiles(self) -> Dict:
-        """Filter profiles based on source video resolution"""
+    @functools.cached_property
+    def filtered_profiles(self) -> Dict:
+        """Profiles to encode for this source, worked out on first use"""
         if not self.video_info:
             self.get_video_info()
 
@@ -114,258 +281,214 @@ class VideoTranscoder:
             smallest_profile = min(self.profiles.items(), key=lambda x: x[1]['width'])
             filtered_profiles[smallest_profile[0]] = smallest_profile[1]
 
+        if not self.static_ladder:
+            filtered_profiles = self._select_ladder(self.video_info, filtered_profiles)
+
         print(f"📊 Will create {len(filtered_profiles)} quality levels: {', '.join(filtered_profiles.keys())}")
         return filtered_profiles
 
-    def create_hls_streams(self) -> Dict[str, str]:
-        """Create HLS streams for all valid profiles"""
-        profiles = self.filter_profiles()
-        hls_dir = self.output_dir / "hls"
-        hls_dir.mkdir(parents=True, exist_ok=True)
+    def _select_ladder(self, video_info: Dict, profiles: Dict) -> Dict:
+        """Pick the rungs worth encoding for this source
 
+        Rungs above the source bitrate are dropped, except the lowest of them,
+        which is kept with its bitrate clamped to the source's so the top rung
+        never spends more bits than the source has. From what is left, the
+        sparsest ladder is kept whose adjacent rungs are at most a
+        content-dependent ratio apart; the ratio comes from the source's bits
+        per pixel, a cheap stand-in for encoding complexity. The top and
+        bottom rungs are always kept.
+        """
+        source_bps = video_info['bitrate']
+        pixel_rate = video_info['width'] * video_info['height'] * video_info['fps']
+        # Assume typical content when ffprobe reports no bitrate
+        bits_per_pixel = source_bps / pixel_rate if pixel_rate and source_bps else 0.1
+        max_ratio = next(ratio for limit, ratio in LADDER_STEPS if bits_per_pixel < limit)
+
+        ordered = sorted(profiles.items(), key=lambda x: x[1]['video_bps'], reverse=True)
+        if source_bps:
+            over = [(name, profile) for name, profile in ordered if profile['video_bps'] > source_bps]
+            ordered = ordered[len(over):]
+            if over:
+                name, profile = over[-1]
+                clamped_kbps = max(source_bps // 1000, 1)
+                clamped = dict(profile, bitrate=f"{clamped_kbps}k", video_bps=clamped_kbps * 1000)
+                clamped['bandwidth'] = clamped['video_bps'] + parse_bitrate(profile['audio_bitrate'])
+                ordered.insert(0, (name, clamped))
+
+        ladder = dict(ordered[:1])
+        top = 0
+        while top < len(ordered) - 1:
+            # Jump to the furthest rung still within max_ratio, or the next one if none is
+            nxt = top + 1
+            while (nxt + 1 < len(ordered)
+                   and ordered[top][1]['video_bps'] <= ordered[nxt + 1][1]['video_bps'] * max_ratio):
+                nxt += 1
+            name, profile = ordered[nxt]
+            ladder[name] = profile
+            top = nxt
+
+        # Keep the configured profile order
+        return {name: ladder[name] for name in profiles if name in ladder}
+
+    def create_all_streams(self) -> Tuple[Dict[str, str], Optional[str]]:
+        """Create the HLS and DASH streams from one set of CMAF segments in a single FFmpeg pass
+
+        The source is decoded once and split into one scaled branch per
+        profile. The dash muxer writes fragmented MP4 segments together with
+        the MPD and, via hls_playlist, HLS playlists for the very same
+        segments, so nothing is encoded, muxed or stored twice.
+        """
+        profiles = self.filtered_profiles
+        has_audio = self.video_info['has_audio']
+        encoder = detect_encoder(CMAF_ENCODERS)
+        # NVENC: decode and scale on the GPU so frames never leave video memory
+        use_cuda = encoder == 'h264_nvenc'
+        scaler = 'scale_cuda' if use_cuda else 'scale'
+        cmaf_dir = self.output_dir / "cmaf"
+        cmaf_dir.mkdir(parents=True, exist_ok=True)
+
+        # [0:v]split=K[s0][s1]...;[s0]scale=426:240[v0];[s1]scale=640:360[v1];...
+        filter_complex = f"[0:v]split={len(profiles)}" + ''.join(f"[s{i}]" for i in range(len(profiles)))
+        cmd = ['ffmpeg']
+        if use_cuda:
+            cmd.extend(['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda'])
+        cmd.extend(['-i', self.input_file])
+        map_args = []
+        output_args = encoder_args(encoder, self.preset)
         hls_outputs = {}
 
-        for profile_name, profile in profiles.items():
-            print(f"🎬 Creating HLS stream: {profile_name} ({profile['width']}x{profile['height']})")
-
-            # Create directory for this profile
-            profile_dir = hls_dir / profile_name
-            profile_dir.mkdir(exist_ok=True)
-
-            playlist_file = profile_dir / "playlist.m3u8"
-            segment_pattern = profile_dir / "segment_%03d.ts"
-
-            # FFmpeg command for HLS
-            cmd = [
-                'ffmpeg', '-i', self.input_file,
-                '-c:v', 'libx264', '-preset', 'medium', '-crf', '23',
-                '-c:a', 'aac',
-                '-b:v', profile['bitrate'],
-                '-b:a', profile['audio_bitrate'],
-                '-vf', f"scale={profile['width']}:{profile['height']}",
-                '-f', 'hls',
-                '-hls_time', str(self.segment_duration),
-                '-hls_list_size', '0',
-                '-hls_segment_filename', str(segment_pattern),
-                str(playlist_file),
-                '-y'  # Overwrite output files
-            ]
-
-            try:
-                # Run FFmpeg with progress
-                result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-                hls_outputs[profile_name] = str(playlist_file)
-                print(f"   ✅ Created: {playlist_file}")
-
-            except subprocess.CalledProcessError as e:
-                print(f"   ❌ Error creating HLS {profile_name}: {e}")
-                if e.stderr:
-                    print(f"      FFmpeg error: {e.stderr[-200:]}")  # Last 200 chars
-
-        return hls_outputs
-
-    def create_dash_stream(self) -> Optional[str]:
-        """Create DASH stream with multiple representations"""
-        profiles = self.filter_profiles()
-        dash_dir = self.output_dir / "dash"
-        dash_dir.mkdir(parents=True, exist_ok=True)
-
-        print(f"🎬 Creating DASH stream with {len(profiles)} representations")
+        for i, (profile_name, profile) in enumerate(profiles.items()):
+            print(f"🎬 Creating HLS/DASH stream: {profile_name} ({profile['width']}x{profile['height']})")
+            # The dash muxer names media playlists after the representation index
+            hls_outputs[profile_name] = str(cmaf_dir / f"media_{i}.m3u8")
 
-        # Build FFmpeg command for DASH
-        cmd = ['ffmpeg', '-i', self.input_file]
+            filter_complex += f";[s{i}]{scaler}={profile['width']}:{profile['height']}[v{i}]"
+            map_args.extend(['-map', f'[v{i}]'])
+            output_args.extend(rate_control_args(profile['video_bps'], i))
 
-        # Add video streams
-        map_args = []
-        output_args = []
+        # Add audio stream (single audio shared by all renditions)
+        if has_audio:
+            map_args.extend(['-map', '0:a:0'])
+            output_args.extend(['-c:a', 'aac', '-b:a', CMAF_AUDIO_BITRATE])
 
-        for i, (profile_name, profile) in enumerate(profiles.items()):
-            # Map video stream
-            map_args.extend(['-map', f'0:v:0'])
-
-            # Video encoding settings for this representation
-            output_args.extend([
-                f'-c:v:{i}', 'libx264',
-                f'-preset:v:{i}', 'medium',
-                f'-b:v:{i}', profile['bitrate'],
-                f'-s:v:{i}', f"{profile['width']}x{profile['height']}"
-            ])
-
-        # Add audio stream (single audio for all)
-        map_args.extend(['-map', '0:a:0'])
-        output_args.extend(['-c:a', 'aac', '-b:a', '128k'])
-
-        # DASH-specific settings
+        # DASH-specific settings, plus HLS playlists over the same segments
         dash_args = [
             '-f', 'dash',
             '-seg_duration', str(self.segment_duration),
-            '-adaptation_sets', 'id=0,streams=v id=1,streams=a',
+            '-adaptation_sets', 'id=0,streams=v id=1,streams=a' if has_audio else 'id=0,streams=v',
             '-use_template', '1',
-            '-use_timeline', '1'
+            '-use_timeline', '1',
+            '-hls_playlist', '1',
+            '-hls_master_name', 'master.m3u8'
         ]
 
-        manifest_file = dash_dir / "manifest.mpd"
+        manifest_file = cmaf_dir / "manifest.mpd"
 
         # Complete command
-        full_cmd = cmd + map_args + output_args + dash_args + [str(manifest_file), '-y']
+        full_cmd = cmd + ['-filter_complex', filter_complex] + map_args + output_args + dash_args + [
+            str(manifest_file), '-y'
+        ]
 
         try:
-            result = subprocess.run(full_cmd, capture_output=True, text=True, check=True)
-            print(f"   ✅ Created: {manifest_file}")
-            return str(manifest_file)
-
+            run_ffmpeg(full_cmd, duration=self.video_info['duration'])
         except subprocess.CalledProcessError as e:
-            print(f"   ❌ Error creating DASH stream: {e}")
+            print(f"   ❌ Error creating HLS/DASH streams: {e}")
             if e.stderr:
-                print(f"      FFmpeg error: {e.stderr[-200:]}")
-            return None
+                print(f"      FFmpeg error: {e.stderr[-200:]}")  # Last 200 chars
+            print("   ↪️  Falling back to separate HLS encodes per profile")
+            hls_outputs = self.create_hls_streams_parallel(profiles)
+            self.dash_url = None
+            if hls_outputs:
+                self.hls_url = "hls/master.m3u8"
+                self.create_master_hls_playlist(hls_outputs)
+            return hls_outputs, None
+
+        print(f"   ✅ Created: {cmaf_dir / 'master.m3u8'}")
+        print(f"   ✅ Created: {manifest_file}")
+
+        return hls_outputs, str(manifest_file)
+
+    def create_hls_streams_parallel(self, profiles: Dict) -> Dict[str, str]:
+        """Encode each HLS profile as its own libx264 job, several at a time"""
+        hls_dir = self.output_dir / "hls"
+        cpu_count = os.cpu_count() or 1
+        max_workers = max(1, min(len(profiles), cpu_count // 2))
+        # Split the cores between the concurrent encodes to avoid oversubscription
+        threads = max(1, cpu_count // max_workers)
+
+        hls_outputs = {}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(_encode_one_hls, self.input_file, name, profile, hls_dir,
+                                self.segment_duration, threads, self.preset)
+                for name, profile in profiles.items()
+            ]
+            for future in as_completed(futures):
+                profile_name, playlist_file = future.result()
+                if playlist_file:
+                    hls_outputs[profile_name] = playlist_file
+
+        # Keep the profile order for the master playlist
+        return {name: hls_outputs[name] for name in profiles if name in hls_outputs}
 
     def create_master_hls_playlist(self, hls_outputs: Dict[str, str]) -> str:
         """Create master HLS playlist for adaptive streaming"""
         master_playlist = self.output_dir / "hls" / "master.m3u8"
 
-        with open(master_playlist, 'w') as f:
-            f.write("#EXTM3U\n#EXT-X-VERSION:6\n\n")
-
-            # Sort profiles by bitrate (highest first)
-            sorted_profiles = sorted(
-                hls_outputs.items(),
-                key=lambda x: int(self.profiles[x[0]]['bitrate'].replace('k', '000')),
-                reverse=True
-            )
+        # Sort profiles by bitrate (highest first)
+        sorted_profiles = sorted(
+            hls_outputs.items(),
+            key=lambda x: self.filtered_profiles[x[0]]['video_bps'],
+            reverse=True
+        )
 
-            for profile_name, playlist_path in sorted_profiles:
-                profile = self.profiles[profile_name]
+        lines = ["#EXTM3U\n#EXT-X-VERSION:6\n\n"]
+        for profile_name, playlist_path in sorted_profiles:
+            profile = self.filtered_profiles[profile_name]
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={profile['bandwidth']},"
+                         f"RESOLUTION={profile['width']}x{profile['height']}\n"
+                         f"{profile_name}/playlist.m3u8\n\n")
 
-                # Calculate total bandwidth
-                video_bw = int(profile['bitrate'].replace('k', '000'))
-                audio_bw = int(profile['audio_bitrate'].replace('k', '000'))
-                total_bw = video_bw + audio_bw
-
-                f.write(f"#EXT-X-STREAM-INF:BANDWIDTH={total_bw},")
-                f.write(f"RESOLUTION={profile['width']}x{profile['height']}\n")
-                f.write(f"{profile_name}/playlist.m3u8\n\n")
+        master_playlist.write_text("".join(lines), encoding='ascii')
 
         print(f"✅ Master playlist: {master_playlist}")
         return str(master_playlist)
 
     def create_test_players(self):
         """Create simple HTML test players"""
-
-        # HLS Player
-        hls_player = f"""<!DOCTYPE html>
-<html>
-<head>
-    <title>HLS Player - {Path(self.input_file).stem}</title>
-    <script src="https://vjs.zencdn.net/8.5.2/video.min.js"></script>
-    <link href="https://vjs.zencdn.net/8.5.2/video-js.css" rel="stylesheet">
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 20px; background: #f0f0f0; }}
-        .container {{ max-width: 1000px; margin: 0 auto; background: white; padding: 20px; border-radius: 10px; }}
-        h1 {{ color: #333; }}
-        .video-js {{ margin: 20px 0; }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>🎥 HLS Player</h1>
-        <p>Video: <strong>{Path(self.input_file).name}</strong></p>
-
-        <video-js id="hls-player" class="vjs-default-skin" 
-                  controls preload="auto" width="800" height="450" 
-                  data-setup="{{}}">
-            <source src="hls/master.m3u8" type="application/x-mpegURL">
-            <p class="vjs-no-js">
-                To view this video please enable JavaScript, and consider upgrading to a web browser that
-                <a href="https://videojs.com/html5-video-support/" target="_blank">supports HTML5 video</a>.
-            </p>
-        </video-js>
-
-        <div style="margin-top: 20px;">
-            <h3>Available Streams:</h3>
-            <ul>
-                <li><a href="hls/master.m3u8">Master Playlist (Adaptive)</a></li>
-                <li><a href="dash/manifest.mpd">DASH Manifest</a></li>
-                <li><a href="dash_player.html">DASH Player</a></li>
-            </ul>
-        </div>
-    </div>
-
-    <script>
-        var player = videojs('hls-player');
-        console.log('HLS player initialized');
-    </script>
-</body>
-</html>"""
-
-        # DASH Player
-        dash_player = f"""<!DOCTYPE html>
-<html>
-<head>
-    <title>DASH Player - {Path(self.input_file).stem}</title>
-    <script src="https://cdn.dashjs.org/latest/dash.all.min.js"></script>
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 20px; background: #f0f0f0; }}
-        .container {{ max-width: 1000px; margin: 0 auto; background: white; padding: 20px; border-radius: 10px; }}
-        h1 {{ color: #333; }}
-        video {{ margin: 20px 0; width: 100%; max-width: 800px; height: auto; }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>📺 DASH Player</h1>
-        <p>Video: <strong>{Path(self.input_file).name}</strong></p>
-
-        <video id="dash-player" controls width="800" height="450"></video>
-
-        <div style="margin-top: 20px;">
-            <h3>Stream Information:</h3>
-            <ul>
-                <li><strong>Format:</strong> DASH (Dynamic Adaptive Streaming)</li>
-                <li><strong>Segments:</strong> {self.segment_duration} second chunks</li>
-                <li><strong>Adaptive Bitrate:</strong> Automatically adjusts quality</li>
-            </ul>
-
-            <h3>Available Streams:</h3>
-            <ul>
-                <li><a href="dash/manifest.mpd">DASH Manifest</a></li>
-                <li><a href="hls/master.m3u8">HLS Master Playlist</a></li>
-                <li><a href="hls_player.html">HLS Player</a></li>
-            </ul>
-        </div>
-    </div>
-
-    <script>
-        var url = "dash/manifest.mpd";
-        var player = dashjs.MediaPlayer().create();
-        player.initialize(document.querySelector("#dash-player"), url, true);
-        console.log('DASH player initialized with:', url);
-    </script>
-</body>
-</html>"""
+        fields = {
+            'stem': self.input_stem,
+            'name': self.input_name,
+            'segment_duration': self.segment_duration,
+            'hls_url': self.hls_url,
+            'dash_url': self.dash_url,
+            'dash_links': "",
+        }
+        if self.dash_url:
+            fields['dash_links'] = (f'\n                <li><a href="{self.dash_url}">DASH Manifest</a></li>'
+                                    '\n                <li><a href="dash_player.html">DASH Player</a></li>')
 
         # Write test players
         hls_player_file = self.output_dir / "hls_player.html"
-        dash_player_file = self.output_dir / "dash_player.html"
-
-        with open(hls_player_file, 'w') as f:
-            f.write(hls_player)
-
-        with open(dash_player_file, 'w') as f:
-            f.write(dash_player)
+        hls_player_file.write_text(HLS_PLAYER_TEMPLATE.substitute(fields), encoding='utf-8')
 
         print(f"🌐 Test players created:")
         print(f"   HLS: {hls_player_file}")
-        print(f"   DASH: {dash_player_file}")
+
+        # The HLS fallback has no DASH manifest to play
+        if self.dash_url:
+            dash_player_file = self.output_dir / "dash_player.html"
+            dash_player_file.write_text(DASH_PLAYER_TEMPLATE.substitute(fields), encoding='utf-8')
+            print(f"   DASH: {dash_player_file}")
 
     def create_summary(self):
         """Create a summary file with information about the streams"""
         summary_file = self.output_dir / "README.md"
 
-        content = f"""# Streaming Files for {Path(self.input_file).name}
+        parts = [f"""# Streaming Files for {self.input_name}
 
 ## 📹 Source Video Information
-- **File**: {Path(self.input_file).name}
+- **File**: {self.input_name}
 - **Resolution**: {self.video_info['width']}x{self.video_info['height']}
 - **Duration**: {self.video_info['duration']:.1f} seconds
 - **Frame Rate**: {self.video_info['fps']:.1f} fps
@@ -373,21 +496,28 @@ class VideoTranscoder:
 ## 📂 Generated Files
 
 ### HLS (HTTP Live Streaming)
-- **Master Playlist**: `hls/master.m3u8`
+- **Master Playlist**: `{self.hls_url}`
 - **Test Player**: `hls_player.html`
-
-### DASH (Dynamic Adaptive Streaming over HTTP)  
-- **Manifest**: `dash/manifest.mpd`
+"""]
+        if self.dash_url:
+            parts.append(f"""### DASH (Dynamic Adaptive Streaming over HTTP)
+- **Manifest**: `{self.dash_url}`
 - **Test Player**: `dash_player.html`
-
-## 🎚️ Quality Profiles
-"""
-
-        profiles = self.filter_profiles()
-        for name, profile in profiles.items():
-            content += f"- **{name}**: {profile['width']}x{profile['height']} @ {profile['bitrate']} video, {profile['audio_bitrate']} audio\n"
-
-        content += f"""
+""")
+        parts.append("## 🎚️ Quality Profiles")
+
+        profiles = self.filtered_profiles
+        if self.dash_url:
+            # CMAF output: the profiles share one audio track
+            parts.extend(f"- **{name}**: {profile['width']}x{profile['height']} @ {profile['bitrate']} video"
+                         for name, profile in profiles.items())
+            if self.video_info['has_audio']:
+                parts.append(f"- **Audio**: {CMAF_AUDIO_BITRATE} AAC, shared by every profile")
+        else:
+            parts.extend(f"- **{name}**: {profile['width']}x{profile['height']} @ {profile['bitrate']} video, {profile['audio_bitrate']} audio"
+                         for name, profile in profiles.items())
+
+        parts.append("""
 ## 🚀 How to Use
 
 ### Local Testing
@@ -396,75 +526,113 @@ class VideoTranscoder:
    python3 -m http.server 8000
    ```
 2. Open test players:
-   - HLS: http://localhost:8000/hls_player.html
-   - DASH: http://localhost:8000/dash_player.html
+   - HLS: http://localhost:8000/hls_player.html""")
+        if self.dash_url:
+            parts.append("   - DASH: http://localhost:8000/dash_player.html")
 
+        parts.append(f"""
 ### Integration
-- **HLS URL**: `hls/master.m3u8`
-- **DASH URL**: `dash/manifest.mpd`
-- **Segment Duration**: {self.segment_duration} seconds
-
+- **HLS URL**: `{self.hls_url}`""")
+        if self.dash_url:
+            parts.append(f"- **DASH URL**: `{self.dash_url}`")
+        parts.append(f"- **Segment Duration**: {self.segment_duration} seconds")
+
+        if self.dash_url:
+            layout = """├── cmaf/
+│   ├── master.m3u8        # HLS master playlist
+│   ├── media_*.m3u8       # HLS media playlists
+│   ├── manifest.mpd       # DASH manifest
+│   └── *.m4s              # CMAF segments shared by HLS and DASH
+├── hls_player.html        # HLS test player
+├── dash_player.html       # DASH test player"""
+        else:
+            # Fallback output from create_hls_streams_parallel
+            layout = """├── hls/
+│   ├── master.m3u8        # HLS master playlist
+│   └── <profile>/
+│       ├── playlist.m3u8  # HLS media playlist
+│       ├── init.mp4       # fMP4 initialization segment
+│       └── segment_*.m4s  # fMP4 media segments
+├── hls_player.html        # HLS test player"""
+
+        parts.append(f"""
 ## 📊 Directory Structure
 ```
 {self.output_dir.name}/
-├── hls/
-│   ├── master.m3u8        # Master playlist
-│   ├── 240p/              # Low quality
-│   ├── 360p/              # Mobile quality  
-│   ├── 480p/              # Standard quality
-│   ├── 720p/              # HD quality
-│   └── 1080p/             # Full HD quality
-├── dash/
-│   ├── manifest.mpd       # DASH manifest
-│   └── segments/          # Video/audio segments
-├── hls_player.html        # HLS test player
-├── dash_player.html       # DASH test player
+{layout}
 └── README.md             # This file
 ```
 
 Generated by Simple DASH/HLS Transcoder 🎬
-"""
+""")
 
-        with open(summary_file, 'w') as f:
-            f.write(content)
+        summary_file.write_text("\n".join(parts), encoding='utf-8')
 
         print(f"📄 Summary created: {summary_file}")
 
     def process(self):
         """Main processing function"""
+        return asyncio.run(self._process())
+
+    @staticmethod
+    def process_many(transcoders: List['VideoTranscoder']) -> bool:
+        """Process several inputs in one event loop, checking FFmpeg only once
+
+        The hardware encoder detection and the ffprobe cache are shared as
+        well, so only the first file pays those startup costs.
+        """
+        async def run_all():
+            if not await transcoders[0]._check_ffmpeg_async():
+                return False
+            # One bad input is reported and skipped, the rest still run
+            failed = []
+            for transcoder in transcoders:
+                try:
+                    ok = await transcoder._process(ffmpeg_checked=True)
+                except Exception as e:
+                    print(f"❌ Failed to process {transcoder.input_file}: {e!r}")
+                    ok = False
+                if not ok:
+                    failed.append(transcoder.input_file)
+            if failed and len(transcoders) > 1:
+                print(f"❌ {len(failed)} of {len(transcoders)} inputs failed: {', '.join(failed)}")
+            return not failed
+
+        return asyncio.run(run_all())
+
+    async def _process(self, ffmpeg_checked: bool = False):
+        """Run the pipeline; the startup checks run concurrently"""
         print(f"🎬 Simple DASH/HLS Transcoder")
         print(f"═══════════════════════════════")
         print(f"📁 Input: {self.input_file}")
         print(f"📁 Output: {self.output_dir}")
         print()
 
-        # Check prerequisites
-        if not self.check_ffmpeg():
-            return False
-
-        if not os.path.exists(self.input_file):
+        if not self.input_path.exists():
             print(f"❌ Input file not found: {self.input_file}")
             return False
 
-        # Create output directory
-        self.output_dir.mkdir(exist_ok=True)
-
-        # Get video information
-        self.get_video_info()
+        # Check FFmpeg, probe the input and create the output directory side by side
+        ffmpeg_ok, video_info, mkdir_result = await asyncio.gather(
+            asyncio.sleep(0, result=True) if ffmpeg_checked else self._check_ffmpeg_async(),
+            asyncio.to_thread(self.get_video_info),
+            asyncio.to_thread(self.output_dir.mkdir, parents=True, exist_ok=True),
+            return_exceptions=True
+        )
+        if ffmpeg_ok is not True:
+            return False
+        if isinstance(video_info, TranscodeError):
+            print(f"❌ {video_info}")
+            return False
+        if isinstance(video_info, BaseException):
+            raise video_info
+        if isinstance(mkdir_result, BaseException):
+            raise mkdir_result
         print()
 
-        # Create HLS streams
-        print("🎬 Creating HLS streams...")
-        hls_outputs = self.create_hls_streams()
-        print()
-
-        if hls_outputs:
-            # Create master playlist
-            self.create_master_hls_playlist(hls_outputs)
-
-        # Create DASH stream
-        print("📺 Creating DASH stream...")
-        dash_manifest = self.create_dash_stream()
+        # Create HLS and DASH streams
+        print("🎬 Creating HLS and DASH streams...")
+        hls_outputs, dash_manifest = self.create_all_streams()
         print()
 
         # Create test players
@@ -485,47 +653,114 @@ Generated by Simple DASH/HLS Transcoder 🎬
         print(f"   1. cd {self.output_dir}")
         print("   2. python3 -m http.server 8000")
         print("   3. Open http://localhost:8000/hls_player.html")
-        print("   4. Or http://localhost:8000/dash_player.html")
+        if dash_manifest:
+            print("   4. Or http://localhost:8000/dash_player.html")
         print()
         return True
 
+def _encode_one_hls(input_file: str, profile_name: str, profile: Dict, hls_dir: Path,
+                    segment_duration: int, threads: int,
+                    preset: str = DEFAULT_PRESET) -> Tuple[str, Optional[str]]:
+    """Encode one HLS profile in its own FFmpeg process"""
+    profile_dir = hls_dir / profile_name
+    profile_dir.mkdir(parents=True, exist_ok=True)
+
+    playlist_file = profile_dir / "playlist.m3u8"
+    segment_pattern = profile_dir / "segment_%03d.m4s"
+
+    cmd = [
+        'ffmpeg', '-i', input_file,
+        *encoder_args('libx264', preset),
+        *rate_control_args(profile['video_bps']),
+        '-c:a', 'aac',
+        '-b:a', profile['audio_bitrate'],
+        '-vf', f"scale={profile['width']}:{profile['height']}",
+        '-threads', str(threads),
+        '-f', 'hls',
+        '-hls_time', str(segment_duration),
+        '-hls_list_size', '0',
+        '-hls_segment_type', 'fmp4',
+        '-hls_fmp4_init_filename', 'init.mp4',
+        '-hls_segment_filename', str(segment_pattern),
+        str(playlist_file),
+        '-y'  # Overwrite output files
+    ]
+
+    try:
+        # Several profiles encode at once here, so no progress display
+        run_ffmpeg(cmd)
+        print(f"   ✅ Created: {playlist_file}")
+        return profile_name, str(playlist_file)
+    except subprocess.CalledProcessError as e:
+        print(f"   ❌ Error creating HLS {profile_name}: {e}")
+        if e.stderr:
+            print(f"      FFmpeg error: {e.stderr[-200:]}")  # Last 200 chars
+        return profile_name, None
+
 def main():
+    # asyncio.to_thread arrived in 3.9
+    if sys.version_info < (3, 9):
+        sys.exit("❌ Python 3.9 or newer is required")
+
     parser = argparse.ArgumentParser(
         description='Simple DASH/HLS Video Transcoder using FFmpeg',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""
 Examples:
-  %(prog)s video.mp4                    # Basic usage
-  %(prog)s video.mp4 -o my_stream       # Custom output directory
+  %(prog)s video.mp4                    # Basic usage, writes video_streaming/
+  %(prog)s video.mp4 -o streams         # Writes streams/video_streaming/
   %(prog)s video.mp4 -s 4               # 4-second segments
   %(prog)s video.mp4 --profiles 720p 480p 360p  # Specific quality levels
+  %(prog)s video.mp4 --preset medium    # Slower, slightly smaller encodes
+  %(prog)s video.mp4 --static-ladder    # Every profile up to the source size
+  %(prog)s a.mp4 b.mp4 c.mp4            # Several files, each to <name>_streaming/
         """
     )
 
-    parser.add_argument('input', help='Input video file')
-    parser.add_argument('-o', '--output', help='Output directory (default: input_name_streaming)')
+    parser.add_argument('input', nargs='+', help='Input video file(s)')
+    parser.add_argument('-o', '--output',
+                       help='Parent directory for the <input_name>_streaming directories (default: current directory)')
     parser.add_argument('-s', '--segment-duration', type=int, default=6,
                        help='Segment duration in seconds (default: 6)')
     parser.add_argument('-p','--profiles', nargs='*',
-                       choices=['240p', '360p', '480p', '720p', '1080p'],
+                       choices=list(PROFILES),
                        help='Specific quality profiles to generate')
+    parser.add_argument('--preset', default=DEFAULT_PRESET,
+                       choices=['ultrafast', 'superfast', 'veryfast', 'faster', 'fast',
+                                'medium', 'slow', 'slower', 'veryslow'],
+                       help=f'x264/QSV encoder preset (default: {DEFAULT_PRESET})')
+    parser.add_argument('--static-ladder', action='store_true',
+                       help='Encode every profile that fits the source instead of a content-adaptive subset')
 
     args = parser.parse_args()
 
-    # Create transcoder
-    transcoder = VideoTranscoder(args.input, args.output)
-    transcoder.segment_duration = args.segment_duration
+    # Create transcoders
+    transcoders = []
+    for input_file in args.input:
+        transcoder = VideoTranscoder(input_file, args.output)
+        transcoder.segment_duration = args.segment_duration
+        transcoder.preset = args.preset
+        # Explicitly requested profiles are used as given
+        transcoder.static_ladder = args.static_ladder or bool(args.profiles)
+
+        # Filter profiles if specified
+        if args.profiles:
+            transcoder.profiles = {
+                name: profile for name, profile in transcoder.profiles.items()
+                if name in args.profiles
+            }
+        transcoders.append(transcoder)
+
+    output_dirs = [transcoder.output_dir for transcoder in transcoders]
+    clashes = sorted({str(path) for path in output_dirs if output_dirs.count(path) > 1})
+    if clashes:
+        parser.error(f"inputs with the same name would share an output directory: {', '.join(clashes)}")
 
-    # Filter profiles if specified
     if args.profiles:
-        transcoder.profiles = {
-            name: profile for name, profile in transcoder.profiles.items()
-            if name in args.profiles
-        }
         print(f"🎯 Using specified profiles: {', '.join(args.profiles)}")
 
-    # Process video
-    success = transcoder.process()
+    # Process video(s)
+    success = VideoTranscoder.process_many(transcoders)
 
     if success:
         sys.exit(0)
@@ -5,40 +5,202 @@ Automatically serves streaming files with proper CORS headers
 """
 
 import http.server
-import socketserver
 import argparse
+import email.utils
+import io
 import os
+import signal
 from pathlib import Path
 
+def parse_range(header, size):
+    """Parse a single 'bytes=start-end' Range header into inclusive offsets
+
+    Returns None when the header should be ignored (absent, malformed or
+    asking for several ranges) and raises ValueError when the range lies
+    outside the file. No range of an empty file can be satisfied.
+    """
+    unit, _, spec = (header or '').partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+
+    start, sep, end = spec.strip().partition('-')
+    if not sep or not (start or end) or not all(part.isdigit() for part in (start, end) if part):
+        return None
+
+    if size == 0:
+        raise ValueError(header)
+
+    if not start:
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+# CORS headers, sent with every response so players can read errors too
+CORS_HEADERS = (
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Methods', 'GET, POST, OPTIONS'),
+    ('Access-Control-Allow-Headers', 'Content-Type, Range'),
+)
+
+# No caching for manifests/playlists
+NO_CACHE = (
+    ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+    ('Pragma', 'no-cache'),
+    ('Expires', '0'),
+)
+
+# Cache segments for 1 hour
+SEG_CACHE = (
+    ('Cache-Control', 'public, max-age=3600'),
+)
+
 class StreamingHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     """Custom HTTP handler with CORS and streaming optimizations"""
 
+    # Streaming content types missing from (or wrong in) the mimetypes table
+    _CONTENT_TYPES = {
+        '.m3u8': 'application/vnd.apple.mpegurl',
+        '.mpd': 'application/dash+xml',
+        '.ts': 'video/mp2t',
+        '.m4s': 'video/iso.segment',
+    }
+
+    # Caching headers by file extension
+    _CACHE_HEADERS = {
+        '.m3u8': NO_CACHE,
+        '.mpd': NO_CACHE,
+        '.ts': SEG_CACHE,
+        '.m4s': SEG_CACHE,
+    }
+
+    # Bytes of the open file to send for the current response (None: to EOF)
+    body_length = None
+
+    def send_head(self):
+        """Serve files with ETag/Last-Modified validation and single byte ranges"""
+        self.body_length = None
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or path.endswith('/'):
+            return super().send_head()
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            # Let the base class produce the 404
+            return super().send_head()
+
+        try:
+            st = os.fstat(f.fileno())
+            etag = f'"{st.st_ino:x}-{int(st.st_mtime):x}-{st.st_size:x}"'
+
+            if self._not_modified(etag, st.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                f.close()
+                return None
+
+            try:
+                byte_range = parse_range(self.headers.get('Range'), st.st_size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{st.st_size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                f.close()
+                return None
+
+            start, end = byte_range or (0, st.st_size - 1)
+            self.send_response(206 if byte_range else 200)
+            self.send_header('Content-type', self.guess_type(path))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+            self.send_header('ETag', etag)
+            self.send_header('Accept-Ranges', 'bytes')
+            if byte_range:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{st.st_size}')
+            # Caching only goes on responses that carry the file
+            extension = os.path.splitext(path)[1].lower()
+            for header, value in self._CACHE_HEADERS.get(extension, ()):
+                self.send_header(header, value)
+            self.end_headers()
+
+            f.seek(start)
+            self.body_length = end - start + 1
+            return f
+        except:
+            f.close()
+            raise
+
+    def _not_modified(self, etag, mtime):
+        """Check If-None-Match, or If-Modified-Since when no ETag was sent"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        return since is not None and int(mtime) <= since.timestamp()
+
+    def guess_type(self, path):
+        """Content type for a file, with the streaming formats checked first"""
+        content_type = self._CONTENT_TYPES.get(os.path.splitext(path)[1].lower())
+        return content_type or super().guess_type(path)
+
     def end_headers(self):
-        # Add CORS headers
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Range')
-
-        # Add caching headers based on file type
-        if self.path.endswith('.m3u8') or self.path.endswith('.mpd'):
-            # No caching for manifests/playlists
-            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Expires', '0')
-        elif self.path.endswith('.ts') or self.path.endswith('.m4s'):
-            # Cache segments for 1 hour
-            self.send_header('Cache-Control', 'public, max-age=3600')
-
-        # Content type headers
-        if self.path.endswith('.m3u8'):
-            self.send_header('Content-Type', 'application/vnd.apple.mpegurl')
-        elif self.path.endswith('.mpd'):
-            self.send_header('Content-Type', 'application/dash+xml')
-        elif self.path.endswith('.ts'):
-            self.send_header('Content-Type', 'video/mp2t')
+        for header, value in CORS_HEADERS:
+            self.send_header(header, value)
 
         super().end_headers()
 
+    def copyfile(self, source, outputfile):
+        """Send regular files with os.sendfile so their bytes never pass through Python
+
+        The response stream is already unbuffered (wbufsize is 0), so the
+        socket fd can be written to directly once the headers are flushed.
+        """
+        try:
+            in_fd = source.fileno()
+            out_fd = outputfile.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            # In-memory bodies such as directory listings
+            return super().copyfile(source, outputfile)
+
+        offset = source.tell()
+        remaining = os.fstat(in_fd).st_size - offset
+        if self.body_length is not None:
+            remaining = min(remaining, self.body_length)
+
+        if not hasattr(os, 'sendfile'):
+            while remaining > 0:
+                chunk = source.read(min(remaining, 64 * 1024))
+                if not chunk:
+                    break
+                outputfile.write(chunk)
+                remaining -= len(chunk)
+            return
+
+        while remaining > 0:
+            sent = os.sendfile(out_fd, in_fd, offset, remaining)
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+
     def do_OPTIONS(self):
         """Handle preflight requests"""
         self.send_response(204)
@@ -46,20 +208,18 @@ class StreamingHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
 
 def find_streaming_directories():
     """Find all streaming output directories"""
-    current_dir = Path.cwd()
-    streaming_dirs = []
-
-    # Look for directories ending with _streaming
-    for item in current_dir.iterdir():
-        if item.is_dir() and item.name.endswith('_streaming'):
-            streaming_dirs.append(item)
-
-    return streaming_dirs
+    # Look for directories ending with _streaming; the name check comes first
+    # and scandir's d_type answers is_dir() without a stat() for plain directories
+    with os.scandir('.') as entries:
+        return [Path(entry.name) for entry in entries
+                if entry.name.endswith('_streaming') and entry.is_dir()]
 
 def main():
     parser = argparse.ArgumentParser(description='Streaming Web Server for DASH/HLS')
     parser.add_argument('-p', '--port', type=int, default=8000, help='Port number (default: 8000)')
     parser.add_argument('-d', '--directory', help='Directory to serve (default: current directory)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Server processes sharing the listening socket (default: 1)')
 
     args = parser.parse_args()
 
@@ -74,6 +234,7 @@ def main():
     print(f"═══════════════════════════════")
     print(f"🏠 Directory: {Path.cwd()}")
     print(f"🔗 Port: {args.port}")
+    print(f"👷 Workers: {args.workers}")
     print(f"📡 URL: http://localhost:{args.port}")
 
     if streaming_dirs:
@@ -90,22 +251,46 @@ def main():
     print(f"   ✅ Proper MIME types for streaming")
     print(f"   ✅ Optimized caching headers")
     print(f"   ✅ Range request support")
+    print(f"   ✅ Concurrent segment downloads")
 
     print(f"\n🛑 Press Ctrl+C to stop the server")
     print("═══════════════════════════════")
 
-    # Start server
+    # Start server, forking extra workers where supported
+    is_worker = False
+    worker_pids = []
+    # Treat SIGTERM like Ctrl+C so the workers are stopped as well
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
-        with socketserver.TCPServer(("", args.port), StreamingHTTPRequestHandler) as httpd:
+        with http.server.ThreadingHTTPServer(("", args.port), StreamingHTTPRequestHandler) as httpd:
+            # Fork only after binding: the workers inherit the one listening
+            # socket, so a port that is already taken still fails here
+            if hasattr(os, 'fork'):
+                for _ in range(args.workers - 1):
+                    pid = os.fork()
+                    if pid == 0:
+                        is_worker = True
+                        worker_pids = []
+                        break
+                    worker_pids.append(pid)
+
             httpd.serve_forever()
     except KeyboardInterrupt:
-        print("\n\n🛑 Server stopped")
+        if not is_worker:
+            print("\n\n🛑 Server stopped")
     except OSError as e:
         if "Address already in use" in str(e):
             print(f"\n❌ Port {args.port} is already in use")
             print(f"   Try a different port: python3 {__file__} -p 8001")
         else:
             print(f"\n❌ Server error: {e}")
+    finally:
+        # Don't leave forked workers running once the main server exits
+        for pid in worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,47 @@
+import unittest
+
+from simple_transcoder import TranscodeError, VideoTranscoder, encoder_args, rate_control_args
+
+
+class SelectLadderTest(unittest.TestCase):
+    # (width, height, source bitrate, expected rungs as name@bitrate)
+    CASES = [
+        (1280, 720, 1_000_000, ['480p@1000k', '240p@400k']),
+        (1280, 720, 4_000_000, ['720p@2500k', '480p@1200k', '240p@400k']),
+        (1920, 1080, 1_000_000, ['480p@1000k', '240p@400k']),
+        (1920, 1080, 5_000_000, ['1080p@4500k', '720p@2500k', '480p@1200k', '240p@400k']),
+        (1920, 1080, 20_000_000, ['1080p@4500k', '720p@2500k', '480p@1200k', '360p@800k', '240p@400k']),
+        (1920, 1080, 0, ['1080p@4500k', '720p@2500k', '480p@1200k', '240p@400k']),
+    ]
+
+    def test_select_ladder(self):
+        transcoder = VideoTranscoder("source.mp4")
+        for width, height, bitrate, expected in self.CASES:
+            with self.subTest(width=width, height=height, bitrate=bitrate):
+                video_info = {'width': width, 'height': height, 'fps': 30.0, 'bitrate': bitrate}
+                profiles = {name: profile for name, profile in transcoder.profiles.items()
+                            if profile['width'] <= width and profile['height'] <= height}
+                ladder = transcoder._select_ladder(video_info, profiles)
+                rungs = [f"{name}@{profile['bitrate']}" for name, profile in reversed(ladder.items())]
+                self.assertEqual(rungs, expected)
+
+    def test_clamped_rung_sets_encoder_bitrate(self):
+        transcoder = VideoTranscoder("source.mp4")
+        video_info = {'width': 1920, 'height': 1080, 'fps': 30.0, 'bitrate': 1_000_000}
+        ladder = transcoder._select_ladder(video_info, transcoder.profiles)
+        top = max(ladder.values(), key=lambda profile: profile['video_bps'])
+        # Nothing in the encoder options may override the clamped -b:v
+        self.assertNotIn('-crf:v', encoder_args('libx264'))
+        self.assertEqual(rate_control_args(top['video_bps'], 0),
+                         ['-b:v:0', '1000k', '-maxrate:v:0', '1100k', '-bufsize:v:0', '1500k'])
+
+
+class GetVideoInfoTest(unittest.TestCase):
+    def test_unreadable_input_raises(self):
+        # Raised rather than sys.exit(), so process_many can skip the input
+        with self.assertRaises(TranscodeError):
+            VideoTranscoder("missing.mp4").get_video_info()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from streaming_server import parse_range
+
+
+class ParseRangeTest(unittest.TestCase):
+    # (Range header, file size, expected offsets or ValueError)
+    CASES = [
+        (None, 100, None),
+        ('bytes=0-49', 100, (0, 49)),
+        ('bytes=50-', 100, (50, 99)),
+        ('bytes=90-200', 100, (90, 99)),
+        ('bytes=-10', 100, (90, 99)),
+        ('bytes=-200', 100, (0, 99)),
+        ('bytes=0-0', 1, (0, 0)),
+        ('items=0-10', 100, None),
+        ('bytes=0-10,20-30', 100, None),
+        ('bytes=-', 100, None),
+        ('bytes=a-b', 100, None),
+        ('bytes=100-', 100, ValueError),
+        ('bytes=50-10', 100, ValueError),
+        ('bytes=-0', 100, ValueError),
+        ('bytes=0-', 0, ValueError),
+        ('bytes=-10', 0, ValueError),
+        (None, 0, None),
+    ]
+
+    def test_parse_range(self):
+        for header, size, expected in self.CASES:
+            with self.subTest(header=header, size=size):
+                if expected is ValueError:
+                    with self.assertRaises(ValueError):
+                        parse_range(header, size)
+                else:
+                    self.assertEqual(parse_range(header, size), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()